@@ -18,6 +18,7 @@ import plotly.express as px
 import plotly.graph_objects as go
 from snowflake.snowpark.context import get_active_session
 from snowflake.snowpark.functions import col, call_function, when_matched, when_not_matched
+from snowflake.snowpark.exceptions import SnowparkSQLException
 
 # =========================================================
 # ページ設定とセッション初期化
@@ -28,7 +29,7 @@ st.set_page_config(
 )
 
 # Snowflakeセッションの取得
-@st.cache_resource
+@st.cache_resource(show_spinner=False)
 def get_snowflake_session():
     """Snowflakeセッションを取得"""
     return get_active_session()
@@ -38,21 +39,29 @@ session = get_snowflake_session()
 # =========================================================
 # 共通関数
 # =========================================================
-def check_table_exists(table_name: str) -> bool:
-    """テーブルが存在するかチェック"""
+@st.cache_data(ttl=60, show_spinner=False)
+def load_existing_tables() -> dict:
+    """現在のスキーマに存在するテーブル名とレコード数（メタデータ）を取得（60秒キャッシュ、失敗時は例外を送出しキャッシュしない）"""
+    rows = session.sql("""
+        SELECT TABLE_NAME, ROW_COUNT FROM INFORMATION_SCHEMA.TABLES
+        WHERE TABLE_SCHEMA = CURRENT_SCHEMA()
+    """).collect()
+    return {row['TABLE_NAME']: row['ROW_COUNT'] or 0 for row in rows}
+
+def get_existing_tables() -> dict:
+    """テーブル名とレコード数の一覧を取得（取得に失敗した場合は空の辞書を返し、次回の呼び出しで再取得）"""
     try:
-        session.sql(f"DESC {table_name}").collect()
-        return True
-    except:
-        return False
+        return load_existing_tables()
+    except SnowparkSQLException:
+        return {}
+
+def check_table_exists(table_name: str) -> bool:
+    """テーブルが存在するかチェック（メタデータのみ参照し、テーブルはスキャンしない）"""
+    return table_name.upper() in get_existing_tables()
 
 def get_table_count(table_name: str) -> int:
-    """テーブルのレコード数を取得"""
-    try:
-        result = session.sql(f"SELECT COUNT(*) as count FROM {table_name}").collect()
-        return result[0]['COUNT']
-    except:
-        return 0
+    """テーブルのレコード数を取得（メタデータのROW_COUNTを参照し、テーブルはスキャンしない）"""
+    return get_existing_tables().get(table_name.upper(), 0)
 
 def display_info_card(title: str, value: str, description: str = ""):
     """情報カードを表示"""
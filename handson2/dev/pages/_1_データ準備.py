@@ -17,6 +17,7 @@ import plotly.express as px
 import plotly.graph_objects as go
 from snowflake.snowpark.context import get_active_session
 from snowflake.snowpark.functions import col, lit
+from snowflake.snowpark.exceptions import SnowparkSQLException
 from datetime import datetime
 import time
 
@@ -24,7 +25,7 @@ import time
 st.set_page_config(layout="wide")
 
 # Snowflakeセッション取得
-@st.cache_resource
+@st.cache_resource(show_spinner=False)
 def get_snowflake_session():
     return get_active_session()
 
@@ -41,6 +42,46 @@ EMBEDDING_MODELS = [
     "nv-embed-qa-4"
 ]
 
+# レビュー前処理SQL（未処理のレビューを対象に、翻訳・感情分析・分割・ベクトル化をまとめて実行）
+# バインド変数: 1. 処理件数（NULLで全件） 2. 埋め込みモデル
+PROCESS_REVIEWS_SQL = """
+    INSERT INTO CUSTOMER_ANALYSIS (
+        review_id, product_id, customer_id, rating, review_text,
+        review_date, purchase_channel, helpful_votes,
+        chunked_text, embedding, sentiment_score
+    )
+    WITH target_reviews AS (
+        -- 未処理のレビューを取得
+        SELECT r.*
+        FROM CUSTOMER_REVIEWS r
+        LEFT JOIN CUSTOMER_ANALYSIS a ON r.review_id = a.review_id
+        WHERE a.review_id IS NULL
+        LIMIT ?
+    ),
+    scored_reviews AS (
+        -- レビュー全体の感情分析（英語翻訳してから実行）
+        SELECT
+            t.*,
+            SNOWFLAKE.CORTEX.『★★★修正対象★★★』(
+                SNOWFLAKE.CORTEX.『★★★修正対象★★★』(t.review_text, '', 'en')
+            ) as sentiment_score
+        FROM target_reviews t
+    )
+    SELECT
+        s.review_id, s.product_id, s.customer_id, s.rating, s.review_text,
+        s.review_date, s.purchase_channel, s.helpful_votes,
+        c.value::string as chunked_text,
+        SNOWFLAKE.CORTEX.『★★★修正対象★★★』(?, c.value::string) as embedding,
+        s.sentiment_score
+    FROM scored_reviews s,
+    -- テキストをチャンクに分割
+    LATERAL FLATTEN(
+        input => SNOWFLAKE.CORTEX.『★★★修正対象★★★』(
+            s.review_text, 'none', 300, 30
+        )
+    ) c
+"""
+
 # session_stateで選択されたembeddingモデルを初期化
 if 'selected_embedding_model' not in st.session_state:
     st.session_state.selected_embedding_model = EMBEDDING_MODELS[0]
@@ -48,105 +89,117 @@ if 'selected_embedding_model' not in st.session_state:
 # =========================================================
 # ユーティリティ関数
 # =========================================================
-def check_table_exists(table_name: str) -> bool:
-    """テーブルの存在確認（複数の方法で確認）"""
-    try:
-        # 方法1: SHOW TABLESを使用してテーブルの存在を確認
-        result = session.sql(f"SHOW TABLES LIKE '{table_name}'").collect()
-        if len(result) > 0:
-            return True
-    except:
-        pass
-    
-    try:
-        # 方法2: 簡単なSELECTクエリを試行
-        session.sql(f"SELECT 1 FROM {table_name} LIMIT 1").collect()
-        return True
-    except:
-        pass
-    
+@st.cache_data(ttl=60, show_spinner=False)
+def load_table_presence(table_names: tuple) -> dict:
+    """複数テーブルの存在を1回のクエリでまとめて確認（60秒キャッシュ、失敗時は例外を送出しキャッシュしない）"""
+    placeholders = ", ".join(["?"] * len(table_names))
+    rows = session.sql(f"""
+        SELECT TABLE_NAME
+        FROM INFORMATION_SCHEMA.TABLES
+        WHERE TABLE_SCHEMA = CURRENT_SCHEMA()
+          AND TABLE_NAME IN ({placeholders})
+    """, params=[name.upper() for name in table_names]).collect()
+    present = {row['TABLE_NAME'] for row in rows}
+    return {name: name.upper() in present for name in table_names}
+
+def get_table_presence(table_names: tuple) -> dict:
+    """複数テーブルの存在確認（取得に失敗した場合は全て未作成として扱い、次回の呼び出しで再取得）"""
     try:
-        # 方法3: DESCRIBE TABLEを試行
-        session.sql(f"DESCRIBE TABLE {table_name}").collect()
-        return True
-    except:
-        pass
-    
-    return False
+        return load_table_presence(table_names)
+    except SnowparkSQLException:
+        return {name: False for name in table_names}
+
+def check_table_exists(table_name: str) -> bool:
+    """テーブルの存在確認"""
+    return get_table_presence((table_name,))[table_name]
 
 def get_table_count(table_name: str) -> int:
-    """テーブルのレコード数を取得"""
+    """テーブルのレコード数を取得（メタデータのROW_COUNTを参照、get_table_countsのキャッシュを共有）"""
+    return get_table_counts((table_name,)).get(table_name, 0)
+
+def get_table_counts(table_names: tuple) -> dict:
+    """複数テーブルのレコード数を取得（取得に失敗した場合は0件として扱い、次回の呼び出しで再取得）"""
+    if not table_names:
+        return {}
     try:
-        result = session.sql(f"SELECT COUNT(*) as count FROM {table_name}").collect()
-        return result[0]['COUNT']
-    except:
-        return 0
+        return load_table_counts(table_names)
+    except SnowparkSQLException:
+        return {table_name: 0 for table_name in table_names}
 
-def process_reviews(embedding_model: str, limit: int = 10):
-    """レビューデータの前処理を実行"""
-    # 未処理のレビューを取得
-    limit_clause = f"LIMIT {limit}" if limit else ""
-    reviews = session.sql(f"""
-        SELECT r.*
+@st.cache_data(ttl=60, show_spinner=False)
+def load_table_counts(table_names: tuple) -> dict:
+    """複数テーブルのレコード数をINFORMATION_SCHEMAのROW_COUNTから1クエリでまとめて取得（60秒キャッシュ、失敗時は例外を送出しキャッシュしない）"""
+    placeholders = ", ".join(["?"] * len(table_names))
+    # ROW_COUNTはメタデータのため、テーブルのスキャンは発生しない
+    rows = session.sql(f"""
+        SELECT TABLE_NAME, ROW_COUNT
+        FROM INFORMATION_SCHEMA.TABLES
+        WHERE TABLE_SCHEMA = CURRENT_SCHEMA()
+          AND TABLE_NAME IN ({placeholders})
+    """, params=[name.upper() for name in table_names]).collect()
+    row_counts = {row['TABLE_NAME']: row['ROW_COUNT'] or 0 for row in rows}
+    return {table_name: row_counts.get(table_name.upper(), 0) for table_name in table_names}
+
+@st.cache_data(ttl=300, show_spinner=False)
+def load_sample_data(table_name: str) -> pd.DataFrame:
+    """テーブルのサンプルデータを取得（VECTOR列は除外、5分キャッシュ）"""
+    # 埋め込みなどのVECTOR列は表示に向かずデータ量も大きいため、取得対象から除外
+    vector_columns = [row['COLUMN_NAME'] for row in session.sql("""
+        SELECT COLUMN_NAME
+        FROM INFORMATION_SCHEMA.COLUMNS
+        WHERE TABLE_SCHEMA = CURRENT_SCHEMA()
+          AND TABLE_NAME = ?
+          AND DATA_TYPE = 'VECTOR'
+    """, params=[table_name.upper()]).collect()]
+    exclude_clause = f" EXCLUDE ({', '.join(vector_columns)})" if vector_columns else ""
+    return session.sql(f"SELECT *{exclude_clause} FROM {table_name} LIMIT 5").to_pandas()
+
+@st.cache_data(show_spinner=False)
+def load_sentiment_distribution(processed_count: int) -> pd.DataFrame:
+    """感情スコア分布を20区間に集計して取得（処理済み件数をキーにキャッシュ）"""
+    # -1.0〜1.0を0.1刻みの区間に分け、区間の中央値をscore_binとして返す
+    return session.sql("""
+        SELECT 
+            -1 + (LEAST(WIDTH_BUCKET(sentiment_score, -1, 1, 20), 20) - 0.5) * 0.1 as score_bin,
+            COUNT(DISTINCT review_id) as review_count
+        FROM CUSTOMER_ANALYSIS
+        GROUP BY 1
+        ORDER BY 1
+    """).to_pandas()
+
+@st.cache_data(show_spinner=False)
+def load_processing_stats(processed_count: int) -> dict:
+    """前処理結果の統計を取得（処理済み件数をキーにキャッシュ）"""
+    return session.sql("""
+        SELECT 
+            COUNT(DISTINCT review_id) as unique_reviews,
+            COUNT(*) as total_chunks,
+            AVG(sentiment_score) as avg_sentiment,
+            MIN(sentiment_score) as min_sentiment,
+            MAX(sentiment_score) as max_sentiment
+        FROM CUSTOMER_ANALYSIS
+    """).collect()[0].as_dict()
+
+@st.cache_data(show_spinner=False)
+def get_unprocessed_count(review_count: int, processed_count: int) -> int:
+    """未処理レビュー数を取得（両テーブルの件数をキーにキャッシュ）"""
+    return session.sql("""
+        SELECT COUNT(*) as count
         FROM CUSTOMER_REVIEWS r
         LEFT JOIN CUSTOMER_ANALYSIS a ON r.review_id = a.review_id
         WHERE a.review_id IS NULL
-        {limit_clause}
-    """).collect()
-    
-    if not reviews:
-        st.info("処理が必要なレビューはありません。")
-        return
-    
-    progress_bar = st.progress(0)
-    progress_text = st.empty()
-    
-    for i, review in enumerate(reviews):
-        # 進捗表示
-        progress = (i + 1) / len(reviews)
-        progress_bar.progress(progress)
-        progress_text.text(f"処理中: {i + 1}/{len(reviews)} 件")
-        
-        # レビュー全体の感情分析（英語翻訳してから実行）
-        translated_text = session.sql("""
-            SELECT SNOWFLAKE.CORTEX.『★★★修正対象★★★』(?, '', 'en') as translated
-        """, params=[review['REVIEW_TEXT']]).collect()[0]['TRANSLATED']
-        
-        sentiment_score = session.sql("""
-            SELECT SNOWFLAKE.CORTEX.『★★★修正対象★★★』(?) as score
-        """, params=[translated_text]).collect()[0]['SCORE']
-        
-        # テキストをチャンクに分割
-        chunks = session.sql("""
-            SELECT t.value as chunk
-            FROM (
-                SELECT SNOWFLAKE.CORTEX.『★★★修正対象★★★』(
-                    ?, 'none', 300, 30
-                ) as split_result
-            ),
-            LATERAL FLATTEN(input => split_result) t
-        """, params=[review['REVIEW_TEXT']]).collect()
-        
-        # 各チャンクを処理してCUSTOMER_ANALYSISに挿入
-        for chunk in chunks:
-            session.sql("""
-                INSERT INTO CUSTOMER_ANALYSIS (
-                    review_id, product_id, customer_id, rating, review_text,
-                    review_date, purchase_channel, helpful_votes,
-                    chunked_text, embedding, sentiment_score
-                )
-                SELECT 
-                    ?, ?, ?, ?, ?, ?, ?, ?, ?,
-                    SNOWFLAKE.CORTEX.『★★★修正対象★★★』(?, ?),
-                    ?
-            """, params=[
-                review['REVIEW_ID'], review['PRODUCT_ID'], review['CUSTOMER_ID'],
-                review['RATING'], review['REVIEW_TEXT'], review['REVIEW_DATE'],
-                review['PURCHASE_CHANNEL'], review['HELPFUL_VOTES'],
-                chunk['CHUNK'], embedding_model, chunk['CHUNK'], sentiment_score
-            ]).collect()
-    
-    progress_text.text(f"完了: {len(reviews)} 件のレビューを処理しました")
+    """).collect()[0]['COUNT']
+
+def process_reviews(embedding_model: str, limit: int = 10):
+    """レビューデータの前処理を実行（1回のINSERT ... SELECTで一括処理）"""
+    # SQL文は固定のまま、件数とモデルのみバインド変数で渡す（limit=Noneは全件）
+    result = session.sql(PROCESS_REVIEWS_SQL, params=[limit, embedding_model]).collect()
+
+    # 件数が変わるためキャッシュを破棄
+    load_table_counts.clear()
+
+    # st.rerun()後に結果を表示できるよう、登録件数をsession_stateに保存
+    st.session_state.last_inserted_chunks = result[0][0] if result else 0
 
 # =========================================================
 # メインページタイトル
@@ -200,11 +253,13 @@ tab1, tab2 = st.tabs(["📋 テーブル確認", "🔍 データサンプル"])
 with tab1:
     st.markdown("#### 📋 既存テーブルの状況確認")
     
-    # テーブル存在確認
+    # テーブル存在確認とレコード数取得（それぞれ1回のクエリで全テーブル分を取得）
+    table_presence = get_table_presence(tuple(existing_tables))
+    table_counts = get_table_counts(tuple(name for name, exists in table_presence.items() if exists))
     table_status = {}
     for table_name, description in existing_tables.items():
-        exists = check_table_exists(table_name)
-        count = get_table_count(table_name) if exists else 0
+        exists = table_presence[table_name]
+        count = table_counts.get(table_name, 0)
         table_status[table_name] = {"exists": exists, "count": count, "description": description}
         
         status_icon = "✅" if exists else "❌"
@@ -236,9 +291,8 @@ with tab2:
             """サンプルデータ表示のフラグメント"""
             if st.button("📄 サンプルデータ表示"):
                 try:
-                    sample_data = session.sql(f"SELECT * FROM {selected_table} LIMIT 5").collect()
-                    if sample_data:
-                        df_sample = pd.DataFrame([row.as_dict() for row in sample_data])
+                    df_sample = load_sample_data(selected_table)
+                    if not df_sample.empty:
                         st.dataframe(df_sample, use_container_width=True)
                     else:
                         st.info("データが見つかりませんでした。")
@@ -292,6 +346,9 @@ else:
                         updated_at TIMESTAMP_NTZ DEFAULT CURRENT_TIMESTAMP()
                     )
                     """).collect()
+                    # テーブル状況のキャッシュを破棄
+                    load_table_presence.clear()
+                    load_table_counts.clear()
                     st.success("✅ 前処理用テーブルを作成しました！")
                     st.rerun()
                         
@@ -301,6 +358,14 @@ else:
         # 前処理用テーブルが存在する場合のメッセージを横いっぱいに表示
         st.success("✅ 前処理用テーブル（CUSTOMER_ANALYSIS）が存在します。")
         
+        # 直前の前処理結果を表示（st.rerun()をまたいで一度だけ表示）
+        if 'last_inserted_chunks' in st.session_state:
+            inserted_count = st.session_state.pop('last_inserted_chunks')
+            if inserted_count == 0:
+                st.info("処理が必要なレビューはありません。")
+            else:
+                st.success(f"✅ 前処理が完了しました: {inserted_count:,} 件のチャンクを登録しました")
+
         col1, col2 = st.columns(2)
         
         with col1:
@@ -311,12 +376,9 @@ else:
             # 前処理実行ボタン
             # 未処理レビュー数の確認
             try:
-                unprocessed_count = session.sql("""
-                    SELECT COUNT(*) as count
-                    FROM CUSTOMER_REVIEWS r
-                    LEFT JOIN CUSTOMER_ANALYSIS a ON r.review_id = a.review_id
-                    WHERE a.review_id IS NULL
-                """).collect()[0]['COUNT']
+                unprocessed_count = get_unprocessed_count(
+                    get_table_count("CUSTOMER_REVIEWS"), processed_count
+                )
                 
                 st.metric("未処理レビュー数", f"{unprocessed_count:,}件")
                 
@@ -326,7 +388,6 @@ else:
                         with st.spinner("レビューデータを前処理中（10件）..."):
                             try:
                                 process_reviews(st.session_state.selected_embedding_model, limit=10)
-                                st.success("✅ 10件のレビューデータの前処理が完了しました！")
                                 st.rerun()
                             except Exception as e:
                                 st.error(f"❌ 前処理エラー: {str(e)}")
@@ -336,7 +397,6 @@ else:
                         with st.spinner("レビューデータを前処理中（全件）..."):
                             try:
                                 process_reviews(st.session_state.selected_embedding_model, limit=None)
-                                st.success("✅ 全件のレビューデータの前処理が完了しました！")
                                 st.rerun()
                             except Exception as e:
                                 st.error(f"❌ 前処理エラー: {str(e)}")
@@ -349,53 +409,46 @@ else:
 # =========================================================
 # セクション3: 前処理結果の確認
 # =========================================================
-if check_table_exists("CUSTOMER_ANALYSIS"):
-    st.markdown("---")
+def section_3_results():
     st.subheader("📈 セクション3: 前処理結果の確認")
     
+    # 処理済み件数が変わったときだけ集計を再実行
+    analysis_count = get_table_count("CUSTOMER_ANALYSIS")
+    
     col1, col2 = st.columns(2)
     
     with col1:
         # 感情スコア分布（レビュー単位で表示）
         try:
-            sentiment_stats = session.sql("""
-                SELECT 
-                    sentiment_score,
-                    COUNT(DISTINCT review_id) as review_count
-                FROM CUSTOMER_ANALYSIS
-                GROUP BY sentiment_score
-                ORDER BY sentiment_score
-            """).collect()
+            sentiment_df = load_sentiment_distribution(analysis_count)
             
-            if sentiment_stats:
-                sentiment_df = pd.DataFrame([row.as_dict() for row in sentiment_stats])
-                fig = px.histogram(sentiment_df, x='SENTIMENT_SCORE', y='REVIEW_COUNT',
-                                 title='感情スコア分布（レビュー単位）', nbins=20,
-                                 labels={'REVIEW_COUNT': 'レビュー数', 'SENTIMENT_SCORE': '感情スコア'})
+            if not sentiment_df.empty:
+                fig = px.bar(sentiment_df, x='SCORE_BIN', y='REVIEW_COUNT',
+                           title='感情スコア分布（レビュー単位）',
+                           labels={'REVIEW_COUNT': 'レビュー数', 'SCORE_BIN': '感情スコア'})
+                fig.update_layout(bargap=0.05)
                 st.plotly_chart(fig, use_container_width=True)
-        except:
+        except SnowparkSQLException:
             st.info("感情スコア分布データを取得できませんでした。")
     
     with col2:
         # 処理統計
         try:
-            stats = session.sql("""
-                SELECT 
-                    COUNT(DISTINCT review_id) as unique_reviews,
-                    COUNT(*) as total_chunks,
-                    AVG(sentiment_score) as avg_sentiment,
-                    MIN(sentiment_score) as min_sentiment,
-                    MAX(sentiment_score) as max_sentiment
-                FROM CUSTOMER_ANALYSIS
-            """).collect()[0]
+            stats = load_processing_stats(analysis_count)
             
             st.metric("処理済みレビュー数", f"{stats['UNIQUE_REVIEWS']:,}件")
             st.metric("総チャンク数", f"{stats['TOTAL_CHUNKS']:,}件")
-            st.metric("平均感情スコア", f"{stats['AVG_SENTIMENT']:.3f}")
+            # 処理済みデータが0件の場合、平均はNULLになる
+            avg_sentiment = stats['AVG_SENTIMENT']
+            st.metric("平均感情スコア", f"{avg_sentiment:.3f}" if avg_sentiment is not None else "-")
             
-        except:
+        except SnowparkSQLException:
             st.info("処理統計を取得できませんでした。")
 
+if check_table_exists("CUSTOMER_ANALYSIS"):
+    st.markdown("---")
+    section_3_results()
+
 # =========================================================
 # 次のステップ
 # =========================================================
@@ -12,11 +12,14 @@
 
 import streamlit as st
 import pandas as pd
+import numpy as np
 import json
+import hashlib
 import plotly.express as px
 import plotly.graph_objects as go
 from snowflake.snowpark.context import get_active_session
 from snowflake.snowpark.functions import col, lit
+from snowflake.snowpark.exceptions import SnowparkSQLException
 from datetime import datetime
 import time
 
@@ -24,7 +27,7 @@ import time
 st.set_page_config(layout="wide")
 
 # Snowflakeセッション取得
-@st.cache_resource
+@st.cache_resource(show_spinner=False)
 def get_snowflake_session():
     return get_active_session()
 
@@ -44,33 +47,148 @@ ANALYSIS_CATEGORIES = [
     "その他"
 ]
 
+# 分類結果の明細ページをsession_stateに保持する最大ページ数
+CLASSIFY_PAGE_CACHE_SIZE = 50
+
+# AI_FILTERのサンプル条件ごとの事前絞り込みキーワード（ILIKEで候補を絞ってからAI_FILTERを実行）
+FILTER_PREFILTER_KEYWORDS = {
+    "配送や梱包に関する問題が言及されているか？": ["配送", "梱包", "届", "発送", "箱"],
+    "商品の品質に満足している表現が含まれるか？": ["品質", "満足", "良い", "良かった", "素晴らしい"],
+    "価格に関する言及が含まれているか？": ["価格", "値段", "円", "高い", "安い", "コスパ"],
+    "カスタマーサービスについて言及しているか？": ["対応", "サービス", "問い合わせ", "店員", "スタッフ"]
+}
+
+# オブジェクトが存在しない場合のSnowflakeエラーコード（一時テーブルが失われたことの検知に使用）
+OBJECT_NOT_FOUND_ERROR_CODE = 2003
+
+# AI関数の計算結果を保存した一時テーブルの作成クエリ（テーブルが失われた場合の作り直しに使用）
+if 'temp_table_sources' not in st.session_state:
+    st.session_state['temp_table_sources'] = {}
+
 # =========================================================
 # ユーティリティ関数
 # =========================================================
-def check_table_exists(table_name: str) -> bool:
-    """テーブルの存在確認"""
-    try:
-        result = session.sql(f"SHOW TABLES LIKE '{table_name}'").collect()
-        if len(result) > 0:
-            return True
-    except:
-        pass
-    
+def hash_key(*values: str) -> str:
+    """入力値から一時テーブル名に使うキーを生成"""
+    return hashlib.sha1("\n".join(values).encode("utf-8")).hexdigest()[:16]
+
+def materialize_temp_table(table_name: str, select_sql: str, params: list) -> None:
+    """AI関数の計算結果を一時テーブルに保存（同名のテーブルが既に存在する場合は再計算しない）"""
+    session.sql(
+        "CREATE TEMPORARY TABLE IF NOT EXISTS IDENTIFIER(?) AS " + select_sql,
+        params=[table_name] + list(params)
+    ).collect()
+    st.session_state['temp_table_sources'][table_name] = (select_sql, list(params))
+
+def is_missing_object_error(error: Exception) -> bool:
+    """参照先のオブジェクトが存在しないことによるエラーかを判定"""
+    return OBJECT_NOT_FOUND_ERROR_CODE in (getattr(error, 'sql_error_code', None), getattr(error, 'errno', None))
+
+def run_with_temp_table(table_name: str, query_fn):
+    """一時テーブルを参照する処理を実行
+    （Snowflakeセッションの再作成などでテーブルが失われていた場合は、記録済みのクエリで作り直して再実行）"""
     try:
-        session.sql(f"SELECT 1 FROM {table_name} LIMIT 1").collect()
-        return True
-    except:
-        pass
-    
-    return False
+        return query_fn()
+    except Exception as e:
+        source = st.session_state['temp_table_sources'].get(table_name)
+        if source is None or not is_missing_object_error(e):
+            raise
+        materialize_temp_table(table_name, *source)
+        return query_fn()
+
+@st.cache_data(ttl=60, show_spinner=False)
+def load_table_statuses(table_names: tuple) -> dict:
+    """複数テーブルの存在確認とレコード数取得を1回のメタデータ参照でまとめて実行（60秒キャッシュ、失敗時は例外を送出しキャッシュしない）"""
+    status = {name: {"exists": False, "count": 0, "version": ""} for name in table_names}
+    placeholders = ", ".join(["?"] * len(table_names))
+    # ROW_COUNT・LAST_ALTEREDはメタデータのため、テーブルのスキャンは発生しない
+    rows = session.sql(f"""
+        SELECT TABLE_NAME, ROW_COUNT, LAST_ALTERED
+        FROM INFORMATION_SCHEMA.TABLES
+        WHERE TABLE_SCHEMA = CURRENT_SCHEMA()
+          AND TABLE_NAME IN ({placeholders})
+    """, params=list(table_names)).collect()
+    for row in rows:
+        # 更新日時と件数の組をデータのバージョンとし、同じ件数での再投入・更新でも変化させる
+        status[row['TABLE_NAME']] = {
+            "exists": True,
+            "count": row['ROW_COUNT'] or 0,
+            "version": f"{row['LAST_ALTERED']}:{row['ROW_COUNT']}"
+        }
+    return status
 
-def get_table_count(table_name: str) -> int:
-    """テーブルのレコード数を取得"""
+def get_table_statuses(table_names: tuple) -> dict:
+    """複数テーブルの存在確認とレコード数取得（取得に失敗した場合は未作成として扱い、次回の呼び出しで再取得）"""
     try:
-        result = session.sql(f"SELECT COUNT(*) as count FROM {table_name}").collect()
-        return result[0]['COUNT']
-    except:
-        return 0
+        return load_table_statuses(table_names)
+    except SnowparkSQLException:
+        return {name: {"exists": False, "count": 0, "version": ""} for name in table_names}
+
+@st.cache_data(show_spinner=False)
+def get_review_text_count(reviews_version: str) -> int:
+    """レビュー本文を持つレコード数を取得（レビューデータのバージョンをキーにキャッシュ）"""
+    return session.sql("""
+        SELECT COUNT(*) as count FROM CUSTOMER_REVIEWS WHERE review_text IS NOT NULL
+    """).collect()[0]['COUNT']
+
+def build_integrated_figures(df_results: pd.DataFrame, is_positive: np.ndarray, is_negative: np.ndarray) -> dict:
+    """統合分析の全体チャート（感情分布・カテゴリ別・チャネル別）をまとめて作成"""
+    # 感情分布
+    sentiment_labels = np.select([is_positive, is_negative], ['ポジティブ', 'ネガティブ'], default='ニュートラル')
+    sentiment_counts = pd.Series(sentiment_labels).value_counts()
+    sentiment_fig = px.pie(
+        values=sentiment_counts.values,
+        names=sentiment_counts.index,
+        title="感情分布",
+        color_discrete_map={
+            'ポジティブ': '#2E8B57',
+            'ニュートラル': '#FFD700', 
+            'ネガティブ': '#DC143C'
+        }
+    )
+    
+    # カテゴリ別感情スコア
+    category_sentiment = df_results.groupby('CATEGORY')['SENTIMENT_SCORE'].mean().reset_index()
+    category_fig = px.bar(
+        category_sentiment,
+        x='CATEGORY',
+        y='SENTIMENT_SCORE',
+        title="カテゴリ別平均感情スコア",
+        labels={"CATEGORY": "カテゴリ", "SENTIMENT_SCORE": "平均感情スコア"},
+        color='SENTIMENT_SCORE',
+        color_continuous_scale='RdYlGn'
+    )
+    category_fig.add_hline(y=0, line_dash="dash", line_color="black", annotation_text="ニュートラル")
+    
+    # チャネル別の件数・平均評価・平均感情スコアを1回の集計で算出
+    channel_analysis = df_results.groupby('PURCHASE_CHANNEL').agg(
+        RATING=('RATING', 'mean'),
+        SENTIMENT_SCORE=('SENTIMENT_SCORE', 'mean'),
+        N=('REVIEW_ID', 'size')
+    ).reset_index()
+    channel_count_fig = px.bar(
+        channel_analysis.sort_values('N', ascending=False),
+        x='PURCHASE_CHANNEL',
+        y='N',
+        title="購入チャネル別レビュー件数",
+        labels={"PURCHASE_CHANNEL": "購入チャネル", "N": "件数"}
+    )
+    channel_scatter_fig = px.scatter(
+        channel_analysis,
+        x='RATING',
+        y='SENTIMENT_SCORE',
+        size='N',
+        hover_name='PURCHASE_CHANNEL',
+        title="チャネル別：評価 vs 感情スコア",
+        labels={"RATING": "平均評価", "SENTIMENT_SCORE": "平均感情スコア"}
+    )
+    
+    return {
+        'sentiment': sentiment_fig,
+        'category_sentiment': category_fig,
+        'channel_count': channel_count_fig,
+        'channel_scatter': channel_scatter_fig,
+    }
 
 # =========================================================
 # メインページタイトル
@@ -92,11 +210,11 @@ required_tables = {
 
 col1, col2 = st.columns(2)
 
-table_status = {}
+# 存在確認とレコード数を全テーブル分まとめて取得
+table_status = get_table_statuses(tuple(required_tables))
 for table_name, description in required_tables.items():
-    exists = check_table_exists(table_name)
-    count = get_table_count(table_name) if exists else 0
-    table_status[table_name] = {"exists": exists, "count": count}
+    exists = table_status[table_name]["exists"]
+    count = table_status[table_name]["count"]
     
     status_icon = "✅" if exists else "❌"
     
@@ -122,6 +240,9 @@ if not all_tables_exist:
     st.error("⚠️ 必要なテーブルが見つかりません。Step1のデータ準備を完了してください。")
     st.stop()
 
+# レビューデータのバージョン（更新日時・件数が変わった場合はAI関数の計算結果を作り直す）
+reviews_version = table_status["CUSTOMER_REVIEWS"]["version"]
+
 st.markdown("---")
 
 # =========================================================
@@ -178,32 +299,55 @@ def section_2_classify():
                 WHERE review_text IS NOT NULL
                 """
                 
-                results = session.sql(category_query).collect()
+                # 分類結果を一時テーブルに保存（同じ分類クエリ・同じレビューデータでは再計算しない）
+                classify_table = f"TMP_REVIEW_CLASSIFY_{hash_key(category_query, reviews_version)}"
+                materialize_temp_table(classify_table, category_query, [])
+                
+                # カテゴリ・チャネル別の件数と平均評価をサーバー側で集計（CUBEで小計・総計も同時に取得）
+                df_rollup = session.sql("""
+                    SELECT 
+                        category,
+                        purchase_channel,
+                        GROUPING(category) as is_all_categories,
+                        GROUPING(purchase_channel) as is_all_channels,
+                        COUNT(*) as review_count,
+                        AVG(rating) as avg_rating
+                    FROM IDENTIFIER(?)
+                    GROUP BY CUBE(category, purchase_channel)
+                """, params=[classify_table]).to_pandas()
                 
-                if results:
-                    st.success(f"✅ {len(results)}件のレビューを分類完了")
+                if not df_rollup.empty:
+                    total_reviews = int(df_rollup[
+                        (df_rollup['IS_ALL_CATEGORIES'] == 1) & (df_rollup['IS_ALL_CHANNELS'] == 1)
+                    ]['REVIEW_COUNT'].iloc[0])
+                    st.success(f"✅ {total_reviews}件のレビューを分類完了")
                     
-                    df_results = pd.DataFrame([row.as_dict() for row in results])
-                    st.session_state['classify_results'] = df_results
+                    # 明細は保持せず、一時テーブル名と集計結果のみを保持
+                    st.session_state['classify_table'] = classify_table
+                    st.session_state['classify_rollup'] = df_rollup
                     
                     # カテゴリ分布の可視化
+                    category_counts = df_rollup[
+                        (df_rollup['IS_ALL_CATEGORIES'] == 0) & (df_rollup['IS_ALL_CHANNELS'] == 1)
+                    ]
                     col1, col2 = st.columns(2)
                     
                     with col1:
-                        category_counts = df_results['CATEGORY'].value_counts()
                         fig = px.pie(
-                            values=category_counts.values,
-                            names=category_counts.index,
+                            category_counts,
+                            values='REVIEW_COUNT',
+                            names='CATEGORY',
                             title="カテゴリ分布"
                         )
                         st.plotly_chart(fig, use_container_width=True)
                     
                     with col2:
                         fig = px.bar(
-                            x=category_counts.index,
-                            y=category_counts.values,
+                            category_counts.sort_values('REVIEW_COUNT', ascending=False),
+                            x='CATEGORY',
+                            y='REVIEW_COUNT',
                             title="カテゴリ別件数",
-                            labels={"x": "カテゴリ", "y": "件数"}
+                            labels={"CATEGORY": "カテゴリ", "REVIEW_COUNT": "件数"}
                         )
                         st.plotly_chart(fig, use_container_width=True)
                 
@@ -211,39 +355,43 @@ def section_2_classify():
                 st.error(f"❌ 分類エラー: {str(e)}")
     
     # 分類結果の詳細分析機能
-    if 'classify_results' in st.session_state:
-        df_results = st.session_state['classify_results']
+    if 'classify_table' in st.session_state:
+        classify_table = st.session_state['classify_table']
+        df_rollup = st.session_state['classify_rollup']
         
         st.markdown("---")
         st.markdown("#### 📊 カテゴリ別詳細分析")
         
         # カテゴリ選択
+        category_rows = df_rollup[(df_rollup['IS_ALL_CATEGORIES'] == 0) & (df_rollup['IS_ALL_CHANNELS'] == 1)]
         selected_category = st.selectbox(
             "分析したいカテゴリを選択:",
-            ["全カテゴリ"] + sorted(df_results['CATEGORY'].unique().tolist()),
+            ["全カテゴリ"] + sorted(category_rows['CATEGORY'].dropna().tolist()),
             key="category_select"
         )
         
-        # フィルタされたデータ
+        # フィルタされたデータ（件数・平均評価・主要チャネルは集計済みの結果から取得）
         if selected_category == "全カテゴリ":
-            filtered_df = df_results
+            scope = df_rollup[df_rollup['IS_ALL_CATEGORIES'] == 1]
         else:
-            filtered_df = df_results[df_results['CATEGORY'] == selected_category]
+            scope = df_rollup[(df_rollup['IS_ALL_CATEGORIES'] == 0) & (df_rollup['CATEGORY'] == selected_category)]
+        summary = scope[scope['IS_ALL_CHANNELS'] == 1].iloc[0]
+        channel_rows = scope[scope['IS_ALL_CHANNELS'] == 0]
+        review_count = int(summary['REVIEW_COUNT'])
         
         col1, col2, col3 = st.columns(3)
         with col1:
-            st.metric("対象レビュー数", f"{len(filtered_df)}件")
+            st.metric("対象レビュー数", f"{review_count}件")
         with col2:
-            avg_rating = filtered_df['RATING'].mean()
-            st.metric("平均評価", f"{avg_rating:.2f}")
+            st.metric("平均評価", f"{summary['AVG_RATING']:.2f}")
         with col3:
-            if len(filtered_df) > 0:
-                top_channel = filtered_df['PURCHASE_CHANNEL'].mode()[0]
+            if not channel_rows.empty:
+                top_channel = channel_rows.loc[channel_rows['REVIEW_COUNT'].idxmax(), 'PURCHASE_CHANNEL']
                 st.metric("主要チャネル", top_channel)
         
         # ページネーション機能
         items_per_page = st.slider("1ページあたりの表示件数:", 5, 50, 10, key="items_per_page")
-        total_pages = max(1, (len(filtered_df) - 1) // items_per_page + 1)
+        total_pages = max(1, (review_count - 1) // items_per_page + 1)
         
         if total_pages > 1:
             current_page = st.selectbox(
@@ -254,10 +402,36 @@ def section_2_classify():
         else:
             current_page = 1
         
-        # 現在のページのデータ表示
+        # 現在のページのデータのみを一時テーブルから取得して表示
+        # （取得済みのページはsession_stateから再利用し、ウィジェット操作のたびに再取得しない）
         start_idx = (current_page - 1) * items_per_page
-        end_idx = start_idx + items_per_page
-        page_data = filtered_df.iloc[start_idx:end_idx]
+        page_cache = st.session_state.setdefault('classify_page_cache', {})
+        page_key = (classify_table, selected_category, items_per_page, current_page)
+        page_data = page_cache.get(page_key)
+        if page_data is None:
+            try:
+                if selected_category == "全カテゴリ":
+                    page_data = run_with_temp_table(classify_table, lambda: session.sql("""
+                        SELECT review_id, review_text, rating, purchase_channel, category
+                        FROM IDENTIFIER(?)
+                        ORDER BY review_id
+                        LIMIT ? OFFSET ?
+                    """, params=[classify_table, items_per_page, start_idx]).to_pandas())
+                else:
+                    page_data = run_with_temp_table(classify_table, lambda: session.sql("""
+                        SELECT review_id, review_text, rating, purchase_channel, category
+                        FROM IDENTIFIER(?)
+                        WHERE category = ?
+                        ORDER BY review_id
+                        LIMIT ? OFFSET ?
+                    """, params=[classify_table, selected_category, items_per_page, start_idx]).to_pandas())
+                page_cache[page_key] = page_data
+                # 古いページから破棄
+                while len(page_cache) > CLASSIFY_PAGE_CACHE_SIZE:
+                    page_cache.pop(next(iter(page_cache)))
+            except Exception as e:
+                st.error(f"❌ 分類結果の取得エラー: {str(e)}")
+                page_data = pd.DataFrame()
         
         for _, row in page_data.iterrows():
             with st.expander(f"🏷️ {row['CATEGORY']} | 評価: {row['RATING']} | {row['PURCHASE_CHANNEL']}"):
@@ -284,14 +458,16 @@ def section_3_filter():
     )
     
     if filter_input_type == "サンプルから選択":
-        filter_options = [
-            "配送や梱包に関する問題が言及されているか？",
-            "商品の品質に満足している表現が含まれるか？",
-            "価格に関する言及が含まれているか？",
-            "カスタマーサービスについて言及しているか？"
-        ]
+        filter_options = list(FILTER_PREFILTER_KEYWORDS)
         selected_filter = st.selectbox("フィルタ条件を選択:", filter_options)
+        use_prefilter = st.checkbox(
+            "キーワードで事前に絞り込む（高速化）",
+            value=False,
+            key="filter_use_prefilter",
+            help="関連キーワードを含むレビューのみをAI_FILTERの対象にします（キーワードを含まないレビューは対象外になります）"
+        )
     else:
+        use_prefilter = False
         selected_filter = st.text_input(
             "フィルタ条件を入力:",
             placeholder="例：新商品について言及しているか？",
@@ -304,33 +480,42 @@ def section_3_filter():
         else:
             with st.spinner("スマートフィルタリング実行中..."):
                 try:
-                    # AI_FILTER関数で条件マッチング（全件対象）
+                    # 事前絞り込みを使う場合は、キーワードを含むレビューのみをAI_FILTERの対象にする
+                    keywords = FILTER_PREFILTER_KEYWORDS.get(selected_filter, []) if use_prefilter else []
+                    prefilter_clause = ""
+                    if keywords:
+                        prefilter_clause = "AND review_text ILIKE ANY (" + ", ".join(["?"] * len(keywords)) + ")"
+                    
+                    # AI_FILTER関数で条件マッチング（全件対象、WHERE句で絞り込みマッチした行のみ取得）
                     filter_query = f"""
                     SELECT 
                         review_id,
                         review_text,
                         rating,
-                        purchase_channel,
-                        『★★★修正対象★★★』(CONCAT('{selected_filter}: ', review_text)) as filter_result
+                        purchase_channel
                     FROM CUSTOMER_REVIEWS 
                     WHERE review_text IS NOT NULL
+                      {prefilter_clause}
+                      AND 『★★★修正対象★★★』(CONCAT(?, ': ', review_text))
                     """
                     
-                    results = session.sql(filter_query).collect()
+                    filter_params = [f"%{keyword}%" for keyword in keywords] + [selected_filter]
+                    df_matched = session.sql(filter_query, params=filter_params).to_pandas()
                     
-                    if results:
-                        matched_results = [r for r in results if r['FILTER_RESULT']]
-                        
-                        st.success(f"✅ {len(matched_results)}件が条件にマッチしました（全{len(results)}件中）")
+                    # マッチ率の計算用に対象件数のみを取得
+                    total_count = get_review_text_count(reviews_version)
+                    
+                    if total_count:
+                        st.success(f"✅ {len(df_matched)}件が条件にマッチしました（全{total_count}件中）")
                         
-                        if matched_results:
+                        if not df_matched.empty:
                             # マッチ率の可視化
-                            match_rate = len(matched_results) / len(results) * 100
+                            match_rate = len(df_matched) / total_count * 100
                             col1, col2 = st.columns(2)
                             
                             with col1:
                                 fig = px.pie(
-                                    values=[len(matched_results), len(results) - len(matched_results)],
+                                    values=[len(df_matched), total_count - len(df_matched)],
                                     names=['マッチ', '非マッチ'],
                                     title=f"フィルタ結果 (マッチ率: {match_rate:.1f}%)"
                                 )
@@ -338,7 +523,6 @@ def section_3_filter():
                             
                             with col2:
                                 # チャネル別マッチ分析
-                                df_matched = pd.DataFrame([r.as_dict() for r in matched_results])
                                 channel_counts = df_matched['PURCHASE_CHANNEL'].value_counts()
                                 fig = px.bar(
                                     x=channel_counts.index,
@@ -350,15 +534,13 @@ def section_3_filter():
                             
                             # マッチしたレビューの詳細表示
                             st.markdown("#### 📝 マッチしたレビュー詳細")
-                            for result in matched_results[:20]:  # 最初の20件のみ表示
-                                data = result.as_dict()
-                                
+                            for _, data in df_matched.head(20).iterrows():  # 最初の20件のみ表示
                                 with st.expander(f"📋 レビューID: {data['REVIEW_ID']} | 評価: {data['RATING']} | {data['PURCHASE_CHANNEL']}"):
                                     st.write(f"**レビュー内容**: {data['REVIEW_TEXT']}")
                                     st.success(f"**フィルタ結果**: 条件にマッチ")
                             
-                            if len(matched_results) > 20:
-                                st.info(f"さらに{len(matched_results) - 20}件のマッチした結果があります。")
+                            if len(df_matched) > 20:
+                                st.info(f"さらに{len(df_matched) - 20}件のマッチした結果があります。")
                         else:
                             st.info("条件にマッチするレビューが見つかりませんでした。")
                     
@@ -406,7 +588,7 @@ def section_4_agg():
             with st.spinner("購入チャネル別集約分析実行中..."):
                 try:
                     # AI_AGG関数でチャネル別集約分析（TRANSLATE関数で日本語化）
-                    agg_query = f"""
+                    agg_query = """
                     SELECT 
                         purchase_channel,
                         COUNT(*) as review_count,
@@ -414,7 +596,7 @@ def section_4_agg():
                         SNOWFLAKE.CORTEX.TRANSLATE(
                             『★★★修正対象★★★』(
                                 review_text, 
-                                '{selected_agg_prompt}'
+                                ?
                             ),
                             '',
                             'ja'
@@ -424,14 +606,12 @@ def section_4_agg():
                     GROUP BY purchase_channel
                     """
                     
-                    results = session.sql(agg_query).collect()
+                    df_agg = session.sql(agg_query, params=[selected_agg_prompt]).to_pandas()
                     
-                    if results:
-                        st.success(f"✅ {len(results)}つの購入チャネルの分析完了")
+                    if not df_agg.empty:
+                        st.success(f"✅ {len(df_agg)}つの購入チャネルの分析完了")
                         
-                        for result in results:
-                            data = result.as_dict()
-                            
+                        for _, data in df_agg.iterrows():
                             with st.expander(f"📈 {data['PURCHASE_CHANNEL']} チャネル"):
                                 col1, col2 = st.columns(2)
                                 
@@ -469,83 +649,137 @@ def section_5_similarity():
     if st.button("🔗 AI_SIMILARITY実行（全件）", type="primary"):
         with st.spinner("類似レビューを検索中..."):
             try:
-                # AI_SIMILARITY関数で類似度計算（全件対象）
-                similarity_query = f"""
+                # AI_SIMILARITY関数で類似度計算（全件対象）し、結果を一時テーブルに保存
+                # （同じ基準テキストでは再計算せず、閾値の変更は一時テーブルの集計のみで反映）
+                similarity_table = f"TMP_REVIEW_SIMILARITY_{hash_key(base_text, reviews_version)}"
+                similarity_query = """
                 SELECT 
                     review_id,
                     review_text,
                     rating,
                     purchase_channel,
-                    『★★★修正対象★★★』('{base_text}', review_text) as similarity_score
+                    『★★★修正対象★★★』(?, review_text) as similarity_score
                 FROM CUSTOMER_REVIEWS 
                 WHERE review_text IS NOT NULL
-                ORDER BY similarity_score DESC
                 """
+                materialize_temp_table(similarity_table, similarity_query, [base_text])
                 
-                results = session.sql(similarity_query).collect()
+                st.session_state['similarity_table'] = similarity_table
+                st.session_state['similarity_base_text'] = base_text
                 
-                if results:
-                    # 閾値以上の類似度のレビューをフィルタ
-                    similar_reviews = [r for r in results if r['SIMILARITY_SCORE'] >= similarity_threshold]
+            except Exception as e:
+                st.error(f"❌ 類似度分析エラー: {str(e)}")
+    
+    # 類似度計算結果の表示（閾値の変更時はAI_SIMILARITYを再実行しない）
+    if 'similarity_table' in st.session_state:
+        similarity_table = st.session_state['similarity_table']
+        st.caption(f"基準テキスト: {st.session_state['similarity_base_text']}")
+        
+        try:
+            # 一時テーブルの類似度に対して閾値・件数の絞り込みをサーバー側で実行
+            # （互いに独立したクエリのため非同期で同時に投入し、一時テーブルが失われていた場合は作り直して再実行）
+            def query_similarity():
+                counts = session.sql("""
+                    SELECT COUNT(*) as total_count, COUNT_IF(similarity_score >= ?) as match_count
+                    FROM IDENTIFIER(?)
+                """, params=[similarity_threshold, similarity_table]).collect()[0]
+                if not counts['MATCH_COUNT']:
+                    return counts, None, None, None
+                
+                # 該当レビューがある場合のみ、表示用の集計3本を並行して実行
+                channel_job = session.sql("""
+                    SELECT purchase_channel, COUNT(*) as match_count
+                    FROM IDENTIFIER(?)
+                    WHERE similarity_score >= ?
+                    GROUP BY purchase_channel
+                """, params=[similarity_table, similarity_threshold]).collect_nowait()
+                top_job = session.sql("""
+                    SELECT review_id, review_text, rating, purchase_channel, similarity_score
+                    FROM IDENTIFIER(?)
+                    WHERE similarity_score >= ?
+                    ORDER BY similarity_score DESC
+                    LIMIT 15
+                """, params=[similarity_table, similarity_threshold]).collect_nowait()
+                # ヒストグラムは20区間の件数のみを取得（0未満・1以上は両端の区間に含める）
+                histogram_job = session.sql("""
+                    SELECT 
+                        GREATEST(LEAST(WIDTH_BUCKET(similarity_score, 0, 1, 20), 20), 1) as bin,
+                        COUNT(*) as review_count
+                    FROM IDENTIFIER(?)
+                    GROUP BY bin
+                    ORDER BY bin
+                """, params=[similarity_table]).collect_nowait()
+                return (
+                    counts,
+                    channel_job.result("pandas"),
+                    top_job.result("pandas"),
+                    histogram_job.result("pandas"),
+                )
+            
+            counts, df_channels, similar_reviews, df_histogram = run_with_temp_table(similarity_table, query_similarity)
+            total_count = counts['TOTAL_COUNT']
+            match_count = counts['MATCH_COUNT']
+            
+            if total_count:
+                st.success(f"✅ 類似度{similarity_threshold}以上のレビューを{match_count}件発見（全{total_count}件中）")
+                
+                if match_count:
+                    df_histogram['BIN_CENTER'] = (df_histogram['BIN'] - 0.5) / 20
                     
-                    st.success(f"✅ 類似度{similarity_threshold}以上のレビューを{len(similar_reviews)}件発見（全{len(results)}件中）")
+                    # 類似度分布の可視化
+                    col1, col2 = st.columns(2)
                     
-                    if similar_reviews:
-                        # 類似度分布の可視化
-                        df_similarity = pd.DataFrame([r.as_dict() for r in results])
-                        
-                        col1, col2 = st.columns(2)
-                        
-                        with col1:
-                            # 類似度ヒストグラム
-                            fig = px.histogram(
-                                df_similarity,
-                                x='SIMILARITY_SCORE',
-                                nbins=20,
-                                title="類似度分布",
-                                labels={"x": "類似度スコア", "y": "件数"}
-                            )
-                            fig.add_vline(x=similarity_threshold, line_dash="dash", line_color="red", 
-                                        annotation_text=f"閾値: {similarity_threshold}")
-                            st.plotly_chart(fig, use_container_width=True)
-                        
-                        with col2:
-                            # 閾値以上のレビューのチャネル分布
-                            df_filtered = pd.DataFrame([r.as_dict() for r in similar_reviews])
-                            channel_counts = df_filtered['PURCHASE_CHANNEL'].value_counts()
-                            fig = px.pie(
-                                values=channel_counts.values,
-                                names=channel_counts.index,
-                                title=f"類似レビューのチャネル分布"
-                            )
-                            st.plotly_chart(fig, use_container_width=True)
+                    with col1:
+                        # 類似度ヒストグラム
+                        fig = px.bar(
+                            df_histogram,
+                            x='BIN_CENTER',
+                            y='REVIEW_COUNT',
+                            title="類似度分布",
+                            labels={"BIN_CENTER": "類似度スコア", "REVIEW_COUNT": "件数"}
+                        )
+                        fig.update_traces(width=0.05)
+                        fig.update_layout(bargap=0)
+                        fig.add_vline(x=similarity_threshold, line_dash="dash", line_color="red", 
+                                    annotation_text=f"閾値: {similarity_threshold}")
+                        st.plotly_chart(fig, use_container_width=True)
+                    
+                    with col2:
+                        # 閾値以上のレビューのチャネル分布
+                        fig = px.pie(
+                            df_channels,
+                            values='MATCH_COUNT',
+                            names='PURCHASE_CHANNEL',
+                            title=f"類似レビューのチャネル分布"
+                        )
+                        st.plotly_chart(fig, use_container_width=True)
+                    
+                    # 類似レビューの詳細表示
+                    st.markdown("#### 🔗 類似レビュー詳細（上位15件）")
+                    for _, data in similar_reviews.iterrows():
+                        similarity = data['SIMILARITY_SCORE']
                         
-                        # 類似レビューの詳細表示
-                        st.markdown("#### 🔗 類似レビュー詳細（上位15件）")
-                        for result in similar_reviews[:15]:
-                            data = result.as_dict()
-                            similarity = data['SIMILARITY_SCORE']
-                            
-                            # 類似度に応じた色分け
-                            if similarity >= 0.8:
-                                similarity_color = "🟢"
-                            elif similarity >= 0.6:
-                                similarity_color = "🟡"
-                            else:
-                                similarity_color = "🟠"
-                            
-                            with st.expander(f"{similarity_color} レビューID: {data['REVIEW_ID']} | 類似度: {similarity:.3f} | {data['PURCHASE_CHANNEL']}"):
-                                st.write(f"**レビュー内容**: {data['REVIEW_TEXT']}")
-                                st.write(f"**評価**: {data['RATING']}")
-                                st.write(f"**類似度スコア**: {similarity:.3f}")
+                        # 類似度に応じた色分け
+                        if similarity >= 0.8:
+                            similarity_color = "🟢"
+                        elif similarity >= 0.6:
+                            similarity_color = "🟡"
+                        else:
+                            similarity_color = "🟠"
                         
-                        if len(similar_reviews) > 15:
-                            st.info(f"さらに{len(similar_reviews) - 15}件の類似レビューがあります。")
-                    else:
-                        st.info(f"類似度{similarity_threshold}以上のレビューが見つかりませんでした。")
-                
-            except Exception as e:
-                st.error(f"❌ 類似度分析エラー: {str(e)}")
+                        with st.expander(f"{similarity_color} レビューID: {data['REVIEW_ID']} | 類似度: {similarity:.3f} | {data['PURCHASE_CHANNEL']}"):
+                            st.write(f"**レビュー内容**: {data['REVIEW_TEXT']}")
+                            st.write(f"**評価**: {data['RATING']}")
+                            st.write(f"**類似度スコア**: {similarity:.3f}")
+                    
+                    if match_count > 15:
+                        st.info(f"さらに{match_count - 15}件の類似レビューがあります。")
+                else:
+                    st.info(f"類似度{similarity_threshold}以上のレビューが見つかりませんでした。")
+        
+        except Exception as e:
+            st.error(f"❌ 類似度分析エラー: {str(e)}")
+
 
 section_5_similarity()
 
@@ -562,7 +796,7 @@ def section_6_integrated():
         with st.spinner("統合分析実行中..."):
             try:
                 # 複数のAISQLを組み合わせた統合分析（全件対象）
-                # まず基本データを取得
+                # まず感情スコアとカテゴリを1回のスキャンで計算し、一時テーブルに保存
                 base_query = """
                 SELECT 
                     review_id,
@@ -578,51 +812,54 @@ def section_6_integrated():
                 WHERE review_text IS NOT NULL
                 """
                 
-                # AI_SUMMARIZE_AGGを使用してカテゴリ別要約を取得
-                summary_query = """
-                SELECT 
-                    category,
-                    purchase_channel,
-                    SNOWFLAKE.CORTEX.TRANSLATE(
-                        AI_SUMMARIZE_AGG(review_text),
-                        '',
-                        'ja'
-                    ) as category_summary
-                FROM (
+                integrated_table = f"TMP_REVIEW_INTEGRATED_{hash_key(base_query, reviews_version)}"
+                materialize_temp_table(integrated_table, base_query, [])
+                
+                # AI_SUMMARIZE_AGGを使用してカテゴリ別要約を作成し、各レビューに結合した結果を取得
+                # （分類済みの一時テーブルを再利用し、結合もSnowflake側で実行）
+                integrated_query = """
+                WITH summary AS (
                     SELECT 
-                        review_text,
+                        category,
                         purchase_channel,
-                        AI_CLASSIFY(
-                            review_text, 
-                            ARRAY_CONSTRUCT('商品品質', '配送サービス', '価格', 'カスタマーサービス', '店舗環境', 'その他')
-                        ):labels[0]::string as category
-                    FROM CUSTOMER_REVIEWS 
-                    WHERE review_text IS NOT NULL
+                        SNOWFLAKE.CORTEX.TRANSLATE(
+                            AI_SUMMARIZE_AGG(review_text),
+                            '',
+                            'ja'
+                        ) as category_summary
+                    FROM IDENTIFIER(?)
+                    GROUP BY category, purchase_channel
                 )
-                GROUP BY category, purchase_channel
+                SELECT b.*, s.category_summary
+                FROM IDENTIFIER(?) b
+                LEFT JOIN summary s
+                  ON EQUAL_NULL(b.category, s.category)
+                 AND b.purchase_channel = s.purchase_channel
                 """
                 
-                # 基本データを取得
-                base_results = session.sql(base_query).collect()
-                # カテゴリ別要約を取得
-                summary_results = session.sql(summary_query).collect()
+                df_results = session.sql(integrated_query, params=[integrated_table, integrated_table]).to_pandas()
                 
-                if base_results and summary_results:
-                    df_base = pd.DataFrame([row.as_dict() for row in base_results])
-                    df_summary = pd.DataFrame([row.as_dict() for row in summary_results])
-                    
-                    # 基本データとサマリーデータを結合
-                    df_results = df_base.merge(
-                        df_summary, 
-                        on=['CATEGORY', 'PURCHASE_CHANNEL'], 
-                        how='left'
-                    )
+                if not df_results.empty:
+                    # カテゴリ・チャネル別の要約は結合済みの結果から取り出す
+                    df_summary = df_results[['CATEGORY', 'PURCHASE_CHANNEL', 'CATEGORY_SUMMARY']].drop_duplicates(
+                        ['CATEGORY', 'PURCHASE_CHANNEL']
+                    ).reset_index(drop=True)
                     
                     # 統合分析結果をsession_stateに保存
                     st.session_state['integrated_results'] = df_results
-                    st.session_state['category_summaries'] = df_summary
+                    # 結果が変わったためチャートは次回表示時に作り直す
+                    st.session_state.pop('integrated_figures', None)
+                    # カテゴリ別の明細・要約は一度だけ分割し、カテゴリ選択時は辞書から参照
+                    st.session_state['integrated_by_category'] = {
+                        category: group.reset_index(drop=True)
+                        for category, group in df_results.groupby('CATEGORY', sort=False)
+                    }
+                    st.session_state['summaries_by_category'] = {
+                        category: group.reset_index(drop=True)
+                        for category, group in df_summary.groupby('CATEGORY', sort=False)
+                    }
                     
-                    st.success(f"✅ 統合分析完了（{len(base_results)}件のレビュー、{len(summary_results)}のカテゴリ別要約）")
+                    st.success(f"✅ 統合分析完了（{len(df_results)}件のレビュー、{len(df_summary)}のカテゴリ別要約）")
                 
             except Exception as e:
                 st.error(f"❌ 統合分析エラー: {str(e)}")
@@ -630,6 +867,7 @@ def section_6_integrated():
     # 統合分析結果の表示
     if 'integrated_results' in st.session_state:
         df_results = st.session_state['integrated_results']
+        integrated_by_category = st.session_state['integrated_by_category']
         
         # 感情スコアの定義説明
         st.info("""
@@ -639,19 +877,24 @@ def section_6_integrated():
         - **ネガティブ**: -0.1未満 😞
         """)
         
+        # 感情スコアの判定（ベクトル演算で一括判定し、マスクは指標とラベル付けで共有）
+        sentiment_scores = df_results['SENTIMENT_SCORE'].to_numpy(dtype=float)
+        is_positive = sentiment_scores > 0.1
+        is_negative = sentiment_scores < -0.1
+        
         # 全体統計の可視化
         col1, col2, col3, col4 = st.columns(4)
         
         with col1:
-            avg_sentiment = df_results['SENTIMENT_SCORE'].mean()
+            avg_sentiment = np.nanmean(sentiment_scores)  # NULLのスコアは除外して平均
             st.metric("平均感情スコア", f"{avg_sentiment:.3f}")
         
         with col2:
-            positive_ratio = (df_results['SENTIMENT_SCORE'] > 0.1).mean() * 100
+            positive_ratio = is_positive.mean() * 100
             st.metric("ポジティブ率", f"{positive_ratio:.1f}%")
         
         with col3:
-            negative_ratio = (df_results['SENTIMENT_SCORE'] < -0.1).mean() * 100
+            negative_ratio = is_negative.mean() * 100
             st.metric("ネガティブ率", f"{negative_ratio:.1f}%")
         
         with col4:
@@ -661,72 +904,32 @@ def section_6_integrated():
         # 感情とカテゴリの分析グラフ
         st.markdown("#### 📈 詳細分析チャート")
         
+        # グラフは統合分析の結果が更新されたときだけ作り直し、他の操作による再実行では使い回す
+        figures = st.session_state.get('integrated_figures')
+        if figures is None:
+            figures = build_integrated_figures(df_results, is_positive, is_negative)
+            st.session_state['integrated_figures'] = figures
+        
         col1, col2 = st.columns(2)
         
         with col1:
             # 感情分布
-            df_results['sentiment_label'] = df_results['SENTIMENT_SCORE'].apply(
-                lambda x: 'ポジティブ' if x > 0.1 else ('ネガティブ' if x < -0.1 else 'ニュートラル')
-            )
-            sentiment_counts = df_results['sentiment_label'].value_counts()
-            fig = px.pie(
-                values=sentiment_counts.values,
-                names=sentiment_counts.index,
-                title="感情分布",
-                color_discrete_map={
-                    'ポジティブ': '#2E8B57',
-                    'ニュートラル': '#FFD700', 
-                    'ネガティブ': '#DC143C'
-                }
-            )
-            st.plotly_chart(fig, use_container_width=True)
+            st.plotly_chart(figures['sentiment'], use_container_width=True)
         
         with col2:
             # カテゴリ別感情スコア
-            category_sentiment = df_results.groupby('CATEGORY')['SENTIMENT_SCORE'].mean().reset_index()
-            fig = px.bar(
-                category_sentiment,
-                x='CATEGORY',
-                y='SENTIMENT_SCORE',
-                title="カテゴリ別平均感情スコア",
-                labels={"CATEGORY": "カテゴリ", "SENTIMENT_SCORE": "平均感情スコア"},
-                color='SENTIMENT_SCORE',
-                color_continuous_scale='RdYlGn'
-            )
-            fig.add_hline(y=0, line_dash="dash", line_color="black", annotation_text="ニュートラル")
-            st.plotly_chart(fig, use_container_width=True)
+            st.plotly_chart(figures['category_sentiment'], use_container_width=True)
         
         # チャネル別分析
         col1, col2 = st.columns(2)
         
         with col1:
             # チャネル別件数
-            channel_counts = df_results['PURCHASE_CHANNEL'].value_counts()
-            fig = px.bar(
-                x=channel_counts.index,
-                y=channel_counts.values,
-                title="購入チャネル別レビュー件数",
-                labels={"x": "購入チャネル", "y": "件数"}
-            )
-            st.plotly_chart(fig, use_container_width=True)
+            st.plotly_chart(figures['channel_count'], use_container_width=True)
         
         with col2:
             # チャネル別平均評価と感情スコア
-            channel_analysis = df_results.groupby('PURCHASE_CHANNEL').agg({
-                'RATING': 'mean',
-                'SENTIMENT_SCORE': 'mean'
-            }).reset_index()
-            
-            fig = px.scatter(
-                channel_analysis,
-                x='RATING',
-                y='SENTIMENT_SCORE',
-                size=[len(df_results[df_results['PURCHASE_CHANNEL'] == ch]) for ch in channel_analysis['PURCHASE_CHANNEL']],
-                hover_name='PURCHASE_CHANNEL',
-                title="チャネル別：評価 vs 感情スコア",
-                labels={"RATING": "平均評価", "SENTIMENT_SCORE": "平均感情スコア"}
-            )
-            st.plotly_chart(fig, use_container_width=True)
+            st.plotly_chart(figures['channel_scatter'], use_container_width=True)
         
         # カテゴリ別詳細分析
         st.markdown("#### 📋 カテゴリ別詳細分析")
@@ -734,7 +937,7 @@ def section_6_integrated():
         # カテゴリ選択
         analysis_category = st.selectbox(
             "詳細分析するカテゴリを選択:",
-            ["全体概要"] + sorted(df_results['CATEGORY'].unique().tolist()),
+            ["全体概要"] + sorted(integrated_by_category),
             key="analysis_category"
         )
         
@@ -742,21 +945,22 @@ def section_6_integrated():
             # 全体サマリー
             st.markdown("##### 🔍 全体分析サマリー")
             
-            # 感情別上位レビュー
+            # 感情別上位レビュー（スコア配列上で位置を求め、ilocで1行だけ取り出す）
             col1, col2, col3 = st.columns(3)
+            scores = df_results['SENTIMENT_SCORE'].to_numpy(dtype=float)
             
             with col1:
                 st.markdown("**😊 最もポジティブなレビュー**")
-                most_positive = df_results.loc[df_results['SENTIMENT_SCORE'].idxmax()]
+                most_positive = df_results.iloc[int(np.nanargmax(scores))]
                 st.write(f"感情スコア: {most_positive['SENTIMENT_SCORE']:.3f}")
                 st.write(f"カテゴリ: {most_positive['CATEGORY']}")
                 st.write(f"レビュー: {most_positive['REVIEW_TEXT'][:100]}...")
             
             with col2:
                 st.markdown("**😐 最もニュートラルなレビュー**")
-                df_neutral = df_results[abs(df_results['SENTIMENT_SCORE']) < 0.1]
-                if not df_neutral.empty:
-                    most_neutral = df_neutral.loc[df_neutral['SENTIMENT_SCORE'].abs().idxmin()]
+                neutral_positions = np.flatnonzero(np.abs(scores) < 0.1)
+                if neutral_positions.size > 0:
+                    most_neutral = df_results.iloc[int(neutral_positions[np.argmin(np.abs(scores[neutral_positions]))])]
                     st.write(f"感情スコア: {most_neutral['SENTIMENT_SCORE']:.3f}")
                     st.write(f"カテゴリ: {most_neutral['CATEGORY']}")
                     st.write(f"レビュー: {most_neutral['REVIEW_TEXT'][:100]}...")
@@ -765,14 +969,14 @@ def section_6_integrated():
             
             with col3:
                 st.markdown("**😞 最もネガティブなレビュー**")
-                most_negative = df_results.loc[df_results['SENTIMENT_SCORE'].idxmin()]
+                most_negative = df_results.iloc[int(np.nanargmin(scores))]
                 st.write(f"感情スコア: {most_negative['SENTIMENT_SCORE']:.3f}")
                 st.write(f"カテゴリ: {most_negative['CATEGORY']}")
                 st.write(f"レビュー: {most_negative['REVIEW_TEXT'][:100]}...")
         
         else:
             # 特定カテゴリの詳細分析
-            category_data = df_results[df_results['CATEGORY'] == analysis_category]
+            category_data = integrated_by_category[analysis_category]
             
             col1, col2, col3 = st.columns(3)
             with col1:
@@ -804,18 +1008,16 @@ def section_6_integrated():
             
             # カテゴリ別AI要約の表示
             st.markdown(f"##### 🤖 {analysis_category} カテゴリのAI_SUMMARIZE_AGG要約")
-            if 'category_summaries' in st.session_state:
-                df_summaries = st.session_state['category_summaries']
-                category_summaries = df_summaries[df_summaries['CATEGORY'] == analysis_category]
-                
+            category_summaries = st.session_state['summaries_by_category'].get(analysis_category)
+            if category_summaries is not None:
                 for _, summary_row in category_summaries.iterrows():
                     with st.info(f"**{summary_row['PURCHASE_CHANNEL']}チャネル**: {summary_row['CATEGORY_SUMMARY']}"):
                         pass
             
             # カテゴリ内の全レビュー表示（ページネーション付き）
             st.markdown(f"##### 📝 {analysis_category} カテゴリのレビュー詳細")
-            for _, row in page_data_6.iterrows():
-                sentiment = row['SENTIMENT_SCORE']
+            detail_columns = ['REVIEW_ID', 'REVIEW_TEXT', 'RATING', 'PURCHASE_CHANNEL', 'SENTIMENT_SCORE', 'CATEGORY_SUMMARY']
+            for review_id, review_text, rating, channel, sentiment, category_summary in page_data_6[detail_columns].itertuples(index=False, name=None):
                 if sentiment > 0.1:
                     sentiment_emoji = "😊"
                     sentiment_label = "ポジティブ"
@@ -826,19 +1028,13 @@ def section_6_integrated():
                     sentiment_emoji = "😐"
                     sentiment_label = "ニュートラル"
                 
-                with st.expander(f"{sentiment_emoji} {sentiment_label} ({sentiment:.2f}) | 評価: {row['RATING']} | {row['PURCHASE_CHANNEL']}"):
-                    st.write(f"**レビューID**: {row['REVIEW_ID']}")
-                    st.write(f"**レビュー内容**: {row['REVIEW_TEXT']}")
+                with st.expander(f"{sentiment_emoji} {sentiment_label} ({sentiment:.2f}) | 評価: {rating} | {channel}"):
+                    st.write(f"**レビューID**: {review_id}")
+                    st.write(f"**レビュー内容**: {review_text}")
                     
-                    # 該当するカテゴリ・チャネルの集約要約を表示
-                    if 'category_summaries' in st.session_state:
-                        df_summaries = st.session_state['category_summaries']
-                        matching_summary = df_summaries[
-                            (df_summaries['CATEGORY'] == row['CATEGORY']) & 
-                            (df_summaries['PURCHASE_CHANNEL'] == row['PURCHASE_CHANNEL'])
-                        ]
-                        if not matching_summary.empty:
-                            st.write(f"**このカテゴリ・チャネルのAI集約要約**: {matching_summary.iloc[0]['CATEGORY_SUMMARY']}")
+                    # 該当するカテゴリ・チャネルの集約要約を表示（SQLで結合済みの列を参照）
+                    if pd.notna(category_summary):
+                        st.write(f"**このカテゴリ・チャネルのAI集約要約**: {category_summary}")
 
 section_6_integrated()
 
@@ -9,6 +9,7 @@
 # =========================================================
 
 import streamlit as st
+from collections import deque
 import pandas as pd
 from snowflake.snowpark.context import get_active_session
 
@@ -16,7 +17,7 @@ from snowflake.snowpark.context import get_active_session
 st.set_page_config(layout="wide")
 
 # Snowflakeセッション取得
-@st.cache_resource
+@st.cache_resource(show_spinner=False)
 def get_snowflake_session():
     return get_active_session()
 
@@ -32,27 +33,68 @@ LLM_MODELS = [
     "mistral-large2"
 ]
 
+# チャットボットのペルソナ設定
+PERSONA_OPTIONS = {
+    "親切なアシスタント": "あなたは親切で丁寧なAIアシスタントです。ユーザーの質問に分かりやすく回答してください。",
+    "技術サポート": "あなたは技術サポートの専門家です。技術的な問題を分かりやすく説明し、解決策を提示してください。",
+    "創作アシスタント": "あなたは創造的で発想豊かなアシスタントです。アイデア出しや創作活動をサポートしてください。",
+    "学習サポート": "あなたは優秀な教師です。複雑な概念を分かりやすく説明し、学習をサポートしてください。"
+}
+
+# ペルソナごとのプロンプト先頭部分（固定の指示を先頭に置き、毎回同一の文字列にする）
+PERSONA_PROMPT_PREFIXES = {
+    persona: f"{instruction}\n回答は簡潔で分かりやすく、実用的な内容にしてください。\n\n"
+    for persona, instruction in PERSONA_OPTIONS.items()
+}
+
+# よくある質問のカテゴリ別定義
+FAQ_CATEGORIES = {
+    "一般的な質問": [
+        "こんにちは！何ができますか？",
+        "効率的な時間管理のコツを教えて",
+        "おすすめの読書リストを作成して",
+        "健康的な生活習慣について教えて"
+    ],
+    "技術・データ関連": [
+        "SQLの基本的な使い方を教えて",
+        "AIと機械学習の違いを説明して",
+        "データ分析の手順を教えて",
+        "クラウドサービスの利点は？"
+    ],
+    "創作・アイデア": [
+        "ブログ記事のタイトル案を5つ考えて",
+        "創造的な問題解決のコツは？",
+        "新しいプロジェクトのアイデアをください",
+        "効果的なプレゼンの構成を教えて"
+    ]
+}
+
 # session_stateで選択されたLLMモデルを初期化
 if 'selected_llm_model' not in st.session_state:
     st.session_state.selected_llm_model = LLM_MODELS[0]
 
+# チャット統計の初期化（メッセージ追加時に更新し、表示のたびに履歴を再集計しない）
+if 'chat_stats' not in st.session_state:
+    st.session_state.chat_stats = {"user": 0, "assistant": 0, "user_chars": 0}
+
+# プロンプト用の直近の会話（整形済みの文字列を最新10件まで保持）
+if 'recent_turns' not in st.session_state:
+    st.session_state.recent_turns = deque(maxlen=10)
+
 # =========================================================
 # ユーティリティ関数
 # =========================================================
 def get_ai_response(model: str, prompt: str):
     """AI応答を取得"""
     try:
-        # プロンプトのエスケープ処理
-        escaped_prompt = prompt.replace("'", "''")
-        
-        # 通常のテキスト応答
-        query = f"""
+        # 通常のテキスト応答（モデルとプロンプトはバインド変数で渡すためエスケープ不要）
+        query = """
         SELECT 『★★★修正対象★★★』(
-            '{model}',
-            '{escaped_prompt}'
+            ?,
+            ?
         ) as response
         """
-        result = session.sql(query).collect()
+        result = session.sql(query, params=[model, prompt]).collect()
         if result:
             ai_response = result[0]['RESPONSE']
             
@@ -69,6 +111,23 @@ def get_ai_response(model: str, prompt: str):
     except Exception as e:
         return f"エラーが発生しました: {str(e)}"
 
+def append_message(role: str, content: str):
+    """チャット履歴にメッセージを追加し、統計と直近の会話を更新"""
+    st.session_state.messages.append({"role": role, "content": content})
+    speaker = "ユーザー" if role == "user" else "アシスタント"
+    st.session_state.recent_turns.append(f"{speaker}: {content}\n")
+    st.session_state.chat_stats[role] += 1
+    if role == "user":
+        st.session_state.chat_stats["user_chars"] += len(content)
+
+def format_history_markdown(messages: list) -> str:
+    """過去のチャット履歴を1つのMarkdown文字列にまとめる"""
+    return "\n\n---\n\n".join(
+        f"**👤 ユーザー:** {msg['content']}" if msg["role"] == "user"
+        else f"**🤖 アシスタント:**\n\n{msg['content']}"
+        for msg in messages
+    )
+
 # =========================================================
 # メインページタイトル
 # =========================================================
@@ -97,17 +156,9 @@ selected_llm_model = st.sidebar.selectbox(
 if selected_llm_model != st.session_state.selected_llm_model:
     st.session_state.selected_llm_model = selected_llm_model
 
-# チャットボットのペルソナ設定
-persona_options = {
-    "親切なアシスタント": "あなたは親切で丁寧なAIアシスタントです。ユーザーの質問に分かりやすく回答してください。",
-    "技術サポート": "あなたは技術サポートの専門家です。技術的な問題を分かりやすく説明し、解決策を提示してください。",
-    "創作アシスタント": "あなたは創造的で発想豊かなアシスタントです。アイデア出しや創作活動をサポートしてください。",
-    "学習サポート": "あなたは優秀な教師です。複雑な概念を分かりやすく説明し、学習をサポートしてください。"
-}
-
 selected_persona = st.sidebar.selectbox(
     "チャットボットのペルソナ:",
-    list(persona_options.keys()),
+    list(PERSONA_OPTIONS),
     help="チャットボットの対応スタイルを選択してください"
 )
 
@@ -135,7 +186,12 @@ def section_1_basic_chat():
     # チャット履歴の表示
     if st.session_state.messages:
         st.markdown("#### 💭 チャット履歴")
-        for message in st.session_state.messages:
+        # 過去のやり取りは1つのMarkdownにまとめて描画し、最新のやり取りのみチャット形式で表示
+        past_messages = st.session_state.messages[:-2]
+        if past_messages:
+            with st.container(border=True):
+                st.markdown(format_history_markdown(past_messages))
+        for message in st.session_state.messages[-2:]:
             if message["role"] == "user":
                 with st.chat_message("user", avatar="👤"):
                     st.write(message["content"])
@@ -161,38 +217,32 @@ def section_1_basic_chat():
     if st.button("📤 送信", type="primary", use_container_width=True):
         if user_input:
             # ユーザーメッセージを履歴に追加
-            st.session_state.messages.append({"role": "user", "content": user_input})
-            
-            # システムプロンプトの設定
-            system_prompt = persona_options[selected_persona]
+            append_message("user", user_input)
             
-            # 会話履歴を含むプロンプトの作成
-            conversation_history = ""
-            for msg in st.session_state.messages[-10:]:  # 最新10件のみ使用
-                if msg["role"] == "user":
-                    conversation_history += f"ユーザー: {msg['content']}\n"
-                else:
-                    conversation_history += f"アシスタント: {msg['content']}\n"
+            # 会話履歴を含むプロンプトの作成（最新10件のみ使用）
+            conversation_history = "".join(st.session_state.recent_turns)
             
-            full_prompt = f"""{system_prompt}
-
-以下は今までの会話履歴です：
-{conversation_history}
-
-上記の会話を踏まえて、最新のユーザーの質問に適切に回答してください。回答は簡潔で分かりやすくしてください。"""
+            # 固定のペルソナ部分を先頭に、可変の会話履歴を後ろに配置
+            full_prompt = (
+                PERSONA_PROMPT_PREFIXES[selected_persona]
+                + f"# 会話履歴\n{conversation_history}\n"
+                + "# 指示\n上記の会話を踏まえて、最新のユーザーの質問に回答してください。"
+            )
             
             # AI応答を取得
             with st.spinner("🤔 考え中..."):
                 ai_response = get_ai_response(st.session_state.selected_llm_model, full_prompt)
             
             # AI応答を履歴に追加
-            st.session_state.messages.append({"role": "assistant", "content": ai_response})
+            append_message("assistant", ai_response)
             
             st.rerun()
     
     # チャットクリア処理
     if clear_chat:
         st.session_state.messages = []
+        st.session_state.chat_stats = {"user": 0, "assistant": 0, "user_chars": 0}
+        st.session_state.recent_turns.clear()
         st.rerun()
 
 section_1_basic_chat()
@@ -207,61 +257,34 @@ def section_2_faq():
     st.subheader("💡 セクション2: よくある質問")
     st.markdown("ワンクリックで質問を送信できます。")
     
-    # よくある質問のカテゴリ別定義
-    faq_categories = {
-        "一般的な質問": [
-            "こんにちは！何ができますか？",
-            "効率的な時間管理のコツを教えて",
-            "おすすめの読書リストを作成して",
-            "健康的な生活習慣について教えて"
-        ],
-        "技術・データ関連": [
-            "SQLの基本的な使い方を教えて",
-            "AIと機械学習の違いを説明して",
-            "データ分析の手順を教えて",
-            "クラウドサービスの利点は？"
-        ],
-        "創作・アイデア": [
-            "ブログ記事のタイトル案を5つ考えて",
-            "創造的な問題解決のコツは？",
-            "新しいプロジェクトのアイデアをください",
-            "効果的なプレゼンの構成を教えて"
-        ]
-    }
-    
     # タブでカテゴリ分け
-    tab1, tab2, tab3 = st.tabs(["一般的な質問", "技術・データ関連", "創作・アイデア"])
+    tab1, tab2, tab3 = st.tabs(list(FAQ_CATEGORIES))
     
-    for i, (tab, category) in enumerate(zip([tab1, tab2, tab3], faq_categories.keys())):
+    for i, (tab, category) in enumerate(zip([tab1, tab2, tab3], FAQ_CATEGORIES)):
         with tab:
             st.markdown(f"#### {category}")
             
             # 2列レイアウトで質問ボタンを配置
             cols = st.columns(2)
             
-            for j, question in enumerate(faq_categories[category]):
+            for j, question in enumerate(FAQ_CATEGORIES[category]):
                 with cols[j % 2]:
                     if st.button(question, key=f"faq_{i}_{j}", use_container_width=True):
                         # 質問をチャットに追加
                         if "messages" not in st.session_state:
                             st.session_state.messages = []
                         
-                        st.session_state.messages.append({"role": "user", "content": question})
+                        append_message("user", question)
                         
-                        # システムプロンプトと組み合わせ
-                        system_prompt = persona_options[selected_persona]
-                        full_prompt = f"""{system_prompt}
-
-ユーザーからの質問: {question}
-
-上記の質問に対して、分かりやすく実用的な回答をしてください。"""
+                        # 固定のペルソナ部分を先頭に、質問を後ろに配置
+                        full_prompt = PERSONA_PROMPT_PREFIXES[selected_persona] + f"# 質問\n{question}"
                         
                         # AI応答を取得
                         with st.spinner("🤔 考え中..."):
                             ai_response = get_ai_response(st.session_state.selected_llm_model, full_prompt)
                         
                         # AI応答を履歴に追加
-                        st.session_state.messages.append({"role": "assistant", "content": ai_response})
+                        append_message("assistant", ai_response)
                         
                         st.rerun()
 
@@ -278,10 +301,11 @@ def section_3_statistics():
     
     col1, col2, col3, col4 = st.columns(4)
     
-    # 基本チャットの統計
-    total_messages = len(st.session_state.get('messages', []))
-    user_messages = len([msg for msg in st.session_state.get('messages', []) if msg["role"] == "user"])
-    ai_messages = len([msg for msg in st.session_state.get('messages', []) if msg["role"] == "assistant"])
+    # 基本チャットの統計（メッセージ追加時に集計済みの値を使用）
+    chat_stats = st.session_state.chat_stats
+    user_messages = chat_stats["user"]
+    ai_messages = chat_stats["assistant"]
+    total_messages = user_messages + ai_messages
     
     with col1:
         st.metric("💬 総チャット数", f"{total_messages}件")
@@ -303,7 +327,7 @@ def section_3_statistics():
         
         with col1:
             # 日本語文字数の平均を計算（より適切な指標）
-            avg_chars_per_message = sum(len(msg["content"]) for msg in st.session_state.get('messages', []) if msg["role"] == "user") / max(user_messages, 1)
+            avg_chars_per_message = chat_stats["user_chars"] / max(user_messages, 1)
             st.info(f"平均文字数/質問: {avg_chars_per_message:.1f}文字")
         
         with col2:
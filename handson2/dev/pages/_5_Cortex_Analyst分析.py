@@ -14,18 +14,27 @@
 import streamlit as st
 import pandas as pd
 import json
+import re
+import uuid
 import plotly.express as px
 import plotly.graph_objects as go
 from snowflake.snowpark.context import get_active_session
+from snowflake.snowpark.exceptions import SnowparkSQLException
 from datetime import datetime
 
+# Cortex Analyst APIの呼び出しに使用（Streamlit in Snowflake環境でのみ利用可能）
+try:
+    import _snowflake
+except ImportError:
+    _snowflake = None
+
 # ページ設定
 st.set_page_config(layout="wide")
 
 # =========================================================
 # Snowflakeセッション接続
 # =========================================================
-@st.cache_resource
+@st.cache_resource(show_spinner=False)
 def get_snowflake_session():
     """Snowflakeセッションを取得（キャッシュ付き）"""
     return get_active_session()
@@ -45,6 +54,11 @@ LLM_MODELS = [
 # Cortex Analyst APIの設定
 ANALYST_API_ENDPOINT = "/api/v2/cortex/analyst/message"
 ANALYST_API_TIMEOUT = 50  # 秒
+ANALYST_MAX_ROWS = 10000  # 分析結果としてクライアントに取得する最大行数
+ANALYST_RESULT_CACHE_SIZE = 5  # 全件の分析結果を保持する直近のメッセージ数
+ANALYST_HISTORY_PREVIEW_ROWS = 100  # それより古いメッセージで保持する先頭行数
+ANALYST_HISTORY_DISPLAY_COUNT = 10  # 既定で表示する直近のメッセージ数
+ANALYST_RESPONSE_CACHE_TTL = 1800  # 同じ質問・モデルの分析結果を再利用する秒数
 
 # セマンティックモデルの設定
 SEMANTIC_MODEL_STAGE = "SEMANTIC_MODEL_STAGE"
@@ -56,29 +70,58 @@ if 'selected_llm_model' not in st.session_state:
 # =========================================================
 # ユーティリティ関数
 # =========================================================
-def check_table_exists(table_name: str) -> bool:
-    """テーブルが存在するかチェック"""
-    try:
-        session.sql(f"SELECT 1 FROM {table_name} LIMIT 1").collect()
-        return True
-    except:
-        return False
-
-def get_table_count(table_name: str) -> int:
-    """テーブルのレコード数を取得"""
+@st.cache_data(ttl=60, show_spinner=False)
+def load_existing_tables() -> dict:
+    """現在のスキーマに存在するテーブル名とレコード数（メタデータ）を取得（60秒キャッシュ、失敗時は例外を送出しキャッシュしない）"""
+    rows = session.sql("""
+        SELECT TABLE_NAME, ROW_COUNT FROM INFORMATION_SCHEMA.TABLES
+        WHERE TABLE_SCHEMA = CURRENT_SCHEMA()
+    """).collect()
+    return {row['TABLE_NAME']: row['ROW_COUNT'] or 0 for row in rows}
+
+def get_existing_tables() -> dict:
+    """テーブル名とレコード数の一覧を取得（取得に失敗した場合は空の辞書を返し、次回の呼び出しで再取得）"""
     try:
-        result = session.sql(f"SELECT COUNT(*) as count FROM {table_name}").collect()
-        return result[0]['COUNT']
-    except:
-        return 0
+        return load_existing_tables()
+    except SnowparkSQLException:
+        return {}
 
+def check_table_exists(table_name: str) -> bool:
+    """テーブルが存在するかチェック（メタデータのみ参照し、テーブルはスキャンしない）"""
+    return table_name.upper() in get_existing_tables()
+
+def get_table_status(table_names: tuple) -> dict:
+    """複数テーブルの存在確認とレコード数取得（キャッシュ済みのメタデータのみ参照）"""
+    tables = get_existing_tables()
+    return {
+        name: {"exists": name.upper() in tables, "count": tables.get(name.upper(), 0)}
+        for name in table_names
+    }
+
+@st.cache_data(ttl=120, show_spinner=False)
 def get_all_semantic_models() -> list:
-    """利用可能なセマンティックモデルを取得"""
+    """利用可能なセマンティックモデルを取得（2分キャッシュ）"""
     models = []
     
+    # ビュー一覧の取得とステージの存在確認は互いに独立しているため、非同期で同時に投入
+    # （セマンティックビュー非対応のアカウント・ロールでは投入時点で失敗することもあるため、それぞれ個別に保護）
+    views_job = None
+    try:
+        views_job = session.sql("SHOW SEMANTIC VIEWS").collect_nowait()
+    except SnowparkSQLException:
+        pass
+    stage_job = None
+    try:
+        stage_job = session.sql("""
+            SELECT COUNT(*) as count FROM INFORMATION_SCHEMA.STAGES
+            WHERE STAGE_SCHEMA = CURRENT_SCHEMA() AND STAGE_NAME = ?
+        """, params=[SEMANTIC_MODEL_STAGE]).collect_nowait()
+    except SnowparkSQLException:
+        pass
+    
     # セマンティックビューの取得
     try:
-        semantic_views = session.sql("SHOW SEMANTIC VIEWS").collect()
+        semantic_views = views_job.result() if views_job is not None else []
         for view in semantic_views:
             view_name = view['name']
             models.append({
@@ -86,39 +129,87 @@ def get_all_semantic_models() -> list:
                 "actual_name": view_name,
                 "type": "semantic_view"
             })
-    except Exception:
+    except SnowparkSQLException:
         pass
     
-    # YMLファイルの取得
+    # YMLファイルの取得（ステージが存在しない場合はLISTを実行しない）
     try:
-        yml_files = session.sql(f"LIST @{SEMANTIC_MODEL_STAGE}").collect()
+        stage_exists = stage_job is not None and stage_job.result()[0]['COUNT'] > 0
+        # 拡張子の絞り込みはPATTERNでサーバー側に任せる（.yml / .yaml、大文字小文字を区別しない）
+        yml_files = session.sql(
+            f"LIST @{SEMANTIC_MODEL_STAGE} PATTERN = '.*[.][yY][aA]?[mM][lL]'"
+        ).collect() if stage_exists else []
         for file_info in yml_files:
-            file_name = file_info['name']
-            if file_name.lower().endswith('.yml') or file_name.lower().endswith('.yaml'):
-                file_name_only = file_name.split('/')[-1]
-                actual_path = f"@{SEMANTIC_MODEL_STAGE}/{file_name_only}"
-                models.append({
-                    "display_name": f"[YML] {file_name_only}",
-                    "actual_name": actual_path,
-                    "type": "semantic_model_file"
-                })
-    except Exception:
+            file_name_only = file_info['name'].rsplit('/', 1)[-1]
+            models.append({
+                "display_name": f"[YML] {file_name_only}",
+                "actual_name": f"@{SEMANTIC_MODEL_STAGE}/{file_name_only}",
+                "type": "semantic_model_file"
+            })
+    except SnowparkSQLException:
         pass
     
     return models
 
-def get_model_info_from_display_name(display_name: str, models_list: list) -> dict:
-    """表示名から実際のモデル情報を取得"""
-    for model in models_list:
-        if model["display_name"] == display_name:
-            return {
-                "actual_name": model["actual_name"],
-                "type": model["type"]
-            }
-    return None
+def get_model_info_from_display_name(display_name: str, models_by_display_name: dict) -> dict:
+    """表示名から実際のモデル情報を取得（表示名をキーにした辞書で検索）"""
+    model = models_by_display_name.get(display_name)
+    if model is None:
+        return None
+    return {
+        "actual_name": model["actual_name"],
+        "type": model["type"]
+    }
+
+JAPANESE_TEXT_RATIO = 0.3  # 文字のうち日本語（ひらがな・カタカナ・漢字）がこの割合を超えれば日本語の文章とみなす
+
+def is_japanese_text(text: str) -> bool:
+    """文字に占めるひらがな・カタカナ・漢字の割合で日本語の文章かを簡易判定
+    （英語の回答中に日本語の商品名や質問文の引用が含まれるだけでは日本語と判定しない）"""
+    letters = [c for c in text if c.isalpha()]
+    if not letters:
+        return False
+    japanese_count = sum('\u3040' <= c <= '\u30ff' or '\u4e00' <= c <= '\u9fff' for c in letters)
+    return japanese_count / len(letters) > JAPANESE_TEXT_RATIO
+
+# 文字列リテラル・引用符付き識別子・コメントを先に照合し、それらの内側のCOUNT(DISTINCT ...)は置き換えない
+APPROXIMATE_SQL_PATTERN = re.compile(
+    r"('(?:[^'\\]|\\.|'')*'"      # 文字列リテラル
+    r'|"(?:[^"]|"")*"'             # 引用符付き識別子
+    r"|(?:--|//)[^\n]*"            # 行コメント
+    r"|/\*.*?\*/)"                 # ブロックコメント
+    r"|\bCOUNT\s*\(\s*DISTINCT\s+((?:[^()'\"]|\"(?:[^\"]|\"\")*\")+?)\s*\)",  # 引数は列名（引用符付き識別子を含む）
+    re.IGNORECASE | re.DOTALL,
+)
 
-def execute_cortex_analyst_query(question: str, model_info: dict) -> dict:
-    """Cortex Analyst APIを使用して自然言語質問を分析"""
+def approximate_sql(sql_query: str) -> str:
+    """高速プレビュー用にCOUNT(DISTINCT ...)をAPPROX_COUNT_DISTINCT(...)へ置き換える（文字列・コメント内は対象外）"""
+    return APPROXIMATE_SQL_PATTERN.sub(
+        lambda m: m.group(0) if m.group(1) else f"APPROX_COUNT_DISTINCT({m.group(2)})",
+        sql_query
+    )
+
+def fetch_limited_dataframe(job, max_rows: int = ANALYST_MAX_ROWS) -> tuple:
+    """非同期クエリの結果をバッチ単位で取得し、上限行数を超えた時点で打ち切る"""
+    batches = []
+    row_count = 0
+    for batch in job.result("pandas_batches"):
+        batches.append(batch)
+        row_count += len(batch)
+        if row_count > max_rows:
+            break
+    if not batches:
+        return pd.DataFrame(), False
+    return pd.concat(batches, ignore_index=True).head(max_rows), row_count > max_rows
+
+class AnalystQueryError(Exception):
+    """分析失敗時の結果をキャッシュさせずに呼び出し元へ返すための例外"""
+    def __init__(self, result: dict):
+        super().__init__(result["message"])
+        self.result = result
+
+def call_cortex_analyst(question: str, model_info: dict) -> dict:
+    """Cortex Analyst APIで質問からSQLと説明文を生成し、説明文を日本語に翻訳（失敗時はAnalystQueryErrorを送出）"""
     try:
         messages = [
             {
@@ -135,94 +226,149 @@ def execute_cortex_analyst_query(question: str, model_info: dict) -> dict:
         else:
             request_body["semantic_model_file"] = model_info["actual_name"]
         
-        # Cortex Analyst API呼び出し
-        try:
-            import _snowflake
-            resp = _snowflake.send_snow_api_request(
-                "POST",
-                ANALYST_API_ENDPOINT,
-                {},
-                {},
-                request_body,
-                None,
-                ANALYST_API_TIMEOUT * 1000,
-            )
-            
-            if resp["status"] < 400:
-                response_data = json.loads(resp["content"])
-                if "message" in response_data and "content" in response_data["message"]:
-                    content_list = response_data["message"]["content"]
-                    
-                    response_text = ""
-                    sql_query = ""
-                    result_data = None
-                    
-                    for item in content_list:
-                        if item["type"] == "text":
-                            response_text += item["text"] + "\n\n"
-                        elif item["type"] == "sql":
-                            sql_query = item["statement"]
-                    
-                    # 英語レスポンスを日本語に翻訳
-                    if response_text:
-                        try:
-                            translated_response = session.sql("""
-                                SELECT SNOWFLAKE.CORTEX.TRANSLATE(?, 'en', 'ja') as translated
-                            """, params=[response_text.strip()]).collect()[0]['TRANSLATED']
-                            response_text = translated_response
-                        except Exception:
-                            pass
-                    
-                    # SQLを実行してデータフレームを取得
-                    try:
-                        if sql_query and sql_query.strip():
-                            result_data = session.sql(sql_query).to_pandas()
-                        else:
-                            result_data = pd.DataFrame()
-                    except Exception as sql_error:
-                        return {
-                            "success": False,
-                            "sql": sql_query,
-                            "data": None,
-                            "response_text": response_text,
-                            "message": f"SQL実行エラー: {str(sql_error)}"
-                        }
-                    
-                    return {
-                        "success": True,
-                        "sql": sql_query,
-                        "data": result_data,
-                        "response_text": response_text.strip(),
-                        "message": "分析が正常に完了しました"
-                    }
-                else:
-                    raise Exception("APIレスポンスの形式が不正です")
-            else:
-                error_content = json.loads(resp["content"])
-                error_msg = f"APIエラー (ステータス: {resp['status']}): {error_content.get('message', '不明なエラー')}"
-                raise Exception(error_msg)
-        
-        except ImportError:
-            return {
+        # Cortex Analyst API呼び出し（Streamlit in Snowflake環境でのみ利用可能）
+        if _snowflake is None:
+            raise AnalystQueryError({
                 "success": False,
                 "sql": "",
                 "data": None,
                 "response_text": "",
                 "message": "Cortex Analyst APIにアクセスできません。Streamlit in Snowflake環境で実行してください。"
-            }
+            })
         
+        resp = _snowflake.send_snow_api_request(
+            "POST",
+            ANALYST_API_ENDPOINT,
+            {},
+            {},
+            request_body,
+            None,
+            ANALYST_API_TIMEOUT * 1000,
+        )
+        
+        if resp["status"] < 400:
+            response_data = json.loads(resp["content"])
+            if "message" in response_data and "content" in response_data["message"]:
+                content_list = response_data["message"]["content"]
+                
+                response_text = ""
+                sql_query = ""
+                
+                for item in content_list:
+                    if item["type"] == "text":
+                        response_text += item["text"] + "\n\n"
+                    elif item["type"] == "sql":
+                        sql_query = item["statement"]
+                
+                # 英語レスポンスを日本語に翻訳（レスポンスが既に日本語の場合は翻訳せず、失敗時は英語のまま）
+                if response_text and not is_japanese_text(response_text[:200]):
+                    try:
+                        response_text = session.sql("""
+                            SELECT SNOWFLAKE.CORTEX.TRANSLATE(?, 'en', 'ja') as translated
+                        """, params=[response_text.strip()]).collect()[0]['TRANSLATED']
+                    except Exception:
+                        pass
+                
+                return {"sql": sql_query, "response_text": response_text.strip()}
+            else:
+                raise Exception("APIレスポンスの形式が不正です")
+        else:
+            error_content = json.loads(resp["content"])
+            error_msg = f"APIエラー (ステータス: {resp['status']}): {error_content.get('message', '不明なエラー')}"
+            raise Exception(error_msg)
+        
+    except AnalystQueryError:
+        raise
     except Exception as e:
-        return {
+        raise AnalystQueryError({
             "success": False,
             "sql": "",
             "data": None,
             "response_text": "",
             "message": f"Cortex Analystエラー: {str(e)}"
+        })
+
+@st.cache_data(ttl=ANALYST_RESPONSE_CACHE_TTL, max_entries=64, show_spinner=False)
+def fetch_analyst_response(question: str, model_name: str, model_type: str) -> dict:
+    """成功したAPI応答（生成SQLと翻訳済みの説明文のみ、実行結果のデータは含めない）を（質問, モデル）単位でキャッシュ"""
+    return call_cortex_analyst(question, {"actual_name": model_name, "type": model_type})
+
+def run_cortex_analyst_query(question: str, model_info: dict, refresh: bool = False, approximate: bool = False) -> dict:
+    """キャッシュ済みのAPI応答を利用して分析を実行
+    （SQLは毎回実行して最新のデータを取得、refresh=Trueの場合はAPI応答のキャッシュを破棄して生成し直す、
+    approximate=Trueの場合は近似集計で実行）"""
+    model_name, model_type = model_info["actual_name"], model_info["type"]
+    if refresh:
+        fetch_analyst_response.clear(question, model_name, model_type)
+    try:
+        response = fetch_analyst_response(question, model_name, model_type)
+    except AnalystQueryError as e:
+        return e.result
+    
+    sql_query = response["sql"]
+    # 実際にAPPROX_COUNT_DISTINCTへ置き換えた場合のみ、結果を概算値として扱う
+    is_approximate = False
+    if approximate and sql_query:
+        approximated_sql = approximate_sql(sql_query)
+        is_approximate = approximated_sql != sql_query
+        sql_query = approximated_sql
+    
+    # SQLの実行結果をデータフレームとして取得（上限行数まで）
+    try:
+        if sql_query and sql_query.strip():
+            result_data, truncated = fetch_limited_dataframe(session.sql(sql_query).collect_nowait())
+        else:
+            result_data, truncated = pd.DataFrame(), False
+    except Exception as sql_error:
+        return {
+            "success": False,
+            "sql": sql_query,
+            "data": None,
+            "response_text": response["response_text"],
+            "message": f"SQL実行エラー: {str(sql_error)}"
         }
+    
+    return {
+        "success": True,
+        "sql": sql_query,
+        "data": result_data,
+        "truncated": truncated,
+        "approximate": is_approximate,
+        "response_text": response["response_text"],
+        "message": "分析が正常に完了しました"
+    }
+
+def append_analyst_message(content: str, result: dict):
+    """分析結果を履歴に追加（全件データは直近分のみ保持し、履歴には先頭行のみ残す）"""
+    msg_id = uuid.uuid4().hex
+    data = result.get("data")
+    if data is not None:
+        result_cache = st.session_state.analyst_result_cache
+        result_cache[msg_id] = data
+        # 古い結果から全件データを破棄
+        while len(result_cache) > ANALYST_RESULT_CACHE_SIZE:
+            result_cache.pop(next(iter(result_cache)))
+        result = {**result, "data": data.head(ANALYST_HISTORY_PREVIEW_ROWS)}
+    st.session_state.analyst_chat_history.append({
+        "id": msg_id,
+        "role": "analyst", 
+        "content": content,
+        "result": result
+    })
 
 # =========================================================
 # シンプルなカスタマイズグラフ機能
 # =========================================================
+CURRENCY_STRIP_TABLE = str.maketrans('', '', ',¥')
+NUMERIC_INFERRED_TYPES = {'integer', 'floating', 'decimal', 'mixed-integer-float'}
+
+def to_numeric_column(series: pd.Series) -> pd.Series:
+    """カンマ・円記号付きの文字列列を数値に変換（数値型・日付型など文字列以外の列はそのまま返す）"""
+    if not pd.api.types.is_object_dtype(series):
+        return series
+    # カンマと円記号を1回の走査でまとめて除去
+    return pd.to_numeric(series.astype(str).str.translate(CURRENCY_STRIP_TABLE), errors='coerce')
+
 @st.fragment
 def create_customizable_graph(df: pd.DataFrame, unique_key: str):
     """ユーザーがカスタマイズ可能なグラフを表示する（シンプル版）"""
@@ -233,16 +379,14 @@ def create_customizable_graph(df: pd.DataFrame, unique_key: str):
     st.subheader("📊 カスタマイズグラフ")
     
     # データ情報の表示
-    numeric_cols = []
-    text_cols = []
-    
-    for col in df.columns:
-        # 数値として扱えるかテスト
-        try:
-            pd.to_numeric(df[col].dropna().iloc[:3], errors='raise')
-            numeric_cols.append(col)
-        except (ValueError, TypeError):
-            text_cols.append(col)
+    # 列の型はto_pandas()のdtypeで判定（データ自体は変換しない）
+    numeric_cols = df.select_dtypes(include='number').columns.tolist()
+    # object型で数値（Decimalなど）を保持している列のみ、値の型を推定して補完
+    numeric_cols += [
+        col for col in df.select_dtypes(include='object').columns
+        if pd.api.types.infer_dtype(df[col], skipna=True) in NUMERIC_INFERRED_TYPES
+    ]
+    text_cols = [col for col in df.columns if col not in numeric_cols]
     
     st.info(f"📈 データ: {len(df)}行 x {len(df.columns)}列 | 数値列: {len(numeric_cols)}個 | テキスト列: {len(text_cols)}個")
     
@@ -269,13 +413,13 @@ def create_customizable_graph(df: pd.DataFrame, unique_key: str):
         color_col = None if color_option == "なし" else color_option
         
         # データの数値変換（売上データなど）
-        display_df = df.copy()
+        # グラフに使う列だけをコピーし、ブラウザへ送るデータ量を抑える
+        used_cols = list(dict.fromkeys(col for col in [x_axis, y_axis, color_col] if col is not None))
+        display_df = df[used_cols].copy()
         if y_axis in numeric_cols or 'sales' in y_axis.lower() or '売上' in y_axis.lower():
             try:
                 # カンマ除去と数値変換
-                if display_df[y_axis].dtype == 'object':
-                    display_df[y_axis] = display_df[y_axis].astype(str).str.replace(',', '').str.replace('¥', '')
-                    display_df[y_axis] = pd.to_numeric(display_df[y_axis], errors='coerce')
+                display_df[y_axis] = to_numeric_column(display_df[y_axis])
             except:
                 pass
         
@@ -309,11 +453,9 @@ def create_customizable_graph(df: pd.DataFrame, unique_key: str):
                                    key=f"{unique_key}_value_col")
         
         try:
-            # 数値変換
-            display_df = df.copy()
-            if display_df[value_col].dtype == 'object':
-                display_df[value_col] = display_df[value_col].astype(str).str.replace(',', '').str.replace('¥', '')
-                display_df[value_col] = pd.to_numeric(display_df[value_col], errors='coerce')
+            # 数値変換（使用する列のみ）
+            display_df = df[list(dict.fromkeys([name_col, value_col]))].copy()
+            display_df[value_col] = to_numeric_column(display_df[value_col])
             
             # 円グラフ生成
             pie_df = display_df.groupby(name_col)[value_col].sum().reset_index()
@@ -329,11 +471,9 @@ def create_customizable_graph(df: pd.DataFrame, unique_key: str):
                               key=f"{unique_key}_hist_col")
         
         try:
-            # 数値変換
-            display_df = df.copy()
-            if display_df[hist_col].dtype == 'object':
-                display_df[hist_col] = display_df[hist_col].astype(str).str.replace(',', '').str.replace('¥', '')
-                display_df[hist_col] = pd.to_numeric(display_df[hist_col], errors='coerce')
+            # 数値変換（使用する列のみ）
+            display_df = df[[hist_col]].copy()
+            display_df[hist_col] = to_numeric_column(display_df[hist_col])
             
             fig = px.histogram(display_df, x=hist_col, title=f"{hist_col}の分布")
             st.plotly_chart(fig, use_container_width=True, key=f"{unique_key}_hist_chart")
@@ -378,23 +518,34 @@ enable_charts = st.sidebar.checkbox(
     help="分析結果に対してカスタマイズ可能なグラフ設定を表示"
 )
 
+fast_preview = st.sidebar.checkbox(
+    "⚡ 高速プレビュー",
+    value=False,
+    help="生成SQLのCOUNT(DISTINCT 列名)を近似集計のAPPROX_COUNT_DISTINCTに置き換えて実行（結果は概算値）。引数が式や関数呼び出しの場合は置き換えません"
+)
+
 # セマンティックモデルの選択
 st.sidebar.markdown("---")
 st.sidebar.subheader("📊 セマンティックモデル設定")
 
+# モデル一覧はキャッシュしているため、追加・削除した場合は手動で更新
+if st.sidebar.button("🔄 モデル一覧を更新", help="セマンティックビュー・YMLファイルを再検出"):
+    get_all_semantic_models.clear()
+
 all_semantic_models = get_all_semantic_models()
+models_by_display_name = {model["display_name"]: model for model in all_semantic_models}
 
 if all_semantic_models:
     selected_semantic_model = st.sidebar.selectbox(
         "使用するセマンティックモデル:",
-        [model["display_name"] for model in all_semantic_models],
+        list(models_by_display_name),
         index=0,
         help="分析に使用するセマンティックモデルを選択"
     )
     
     st.sidebar.success("✅ セマンティックモデル選択済み")
     
-    model_info = get_model_info_from_display_name(selected_semantic_model, all_semantic_models)
+    model_info = get_model_info_from_display_name(selected_semantic_model, models_by_display_name)
     if model_info:
         if model_info["type"] == "semantic_view":
             st.sidebar.code(model_info["actual_name"], language="sql")
@@ -433,9 +584,11 @@ required_tables = {
 with col1:
     st.markdown("#### 📄 データソース")
     total_records = 0
+    # 存在確認とレコード数を全テーブル分まとめて取得
+    table_status = get_table_status(tuple(required_tables))
     for table_name, description in required_tables.items():
-        exists = check_table_exists(table_name)
-        count = get_table_count(table_name) if exists else 0
+        exists = table_status[table_name]["exists"]
+        count = table_status[table_name]["count"]
         total_records += count
         status_icon = "✅" if exists else "❌"
         st.write(f"{status_icon} {description}: **{count:,}件**")
@@ -485,11 +638,20 @@ st.subheader("🔍 自然言語データ分析")
 # チャット履歴の初期化
 if "analyst_chat_history" not in st.session_state:
     st.session_state.analyst_chat_history = []
+if "analyst_result_cache" not in st.session_state:
+    st.session_state.analyst_result_cache = {}
 
 # チャット履歴の表示
 if st.session_state.analyst_chat_history:
     st.markdown("#### 💭 分析履歴")
-    for i, message in enumerate(st.session_state.analyst_chat_history):
+    
+    # 長い履歴は直近のメッセージのみ表示し、古いグラフの再描画を避ける
+    history = st.session_state.analyst_chat_history
+    hidden_count = max(len(history) - ANALYST_HISTORY_DISPLAY_COUNT, 0)
+    if hidden_count and not st.toggle(f"📜 すべての履歴を表示（ほか{hidden_count}件）", key="analyst_show_all_history"):
+        history = history[-ANALYST_HISTORY_DISPLAY_COUNT:]
+    
+    for message in history:
         if message["role"] == "user":
             with st.chat_message("user", avatar="👤"):
                 st.write(message["content"])
@@ -497,15 +659,24 @@ if st.session_state.analyst_chat_history:
             with st.chat_message("assistant", avatar="📊"):
                 st.write(message["content"])
                 
-                # 分析結果の表示
+                # 分析結果の表示（直近の結果は全件、古い結果は先頭行のみ）
                 if "result" in message and message["result"]["success"]:
-                    if message["result"]["data"] is not None and not message["result"]["data"].empty:
-                        st.dataframe(message["result"]["data"], use_container_width=True)
+                    result_df = st.session_state.analyst_result_cache.get(message["id"])
+                    if result_df is None:
+                        result_df = message["result"]["data"]
+                    if result_df is not None and not result_df.empty:
+                        st.dataframe(result_df, use_container_width=True)
+                        if message["result"].get("approximate"):
+                            st.caption("⚡ 概算値（COUNT(DISTINCT ...)をAPPROX_COUNT_DISTINCTで集計）")
+                        if message["id"] not in st.session_state.analyst_result_cache:
+                            st.caption(f"ℹ️ 過去の分析結果のため、先頭の{ANALYST_HISTORY_PREVIEW_ROWS}行のみ保持しています")
+                        elif message["result"].get("truncated"):
+                            st.caption(f"⚠️ 結果が多いため、先頭の{ANALYST_MAX_ROWS:,}行のみ表示しています")
                         
                         # グラフ設定の表示
                         if enable_charts:
                             st.info("💡 データが取得できました。下記でグラフをカスタマイズできます。")
-                            create_customizable_graph(message["result"]["data"], f"msg_{i}")
+                            create_customizable_graph(result_df, f"msg_{message['id']}")
                     
                     # 生成されたSQLの表示
                     if message["result"]["sql"]:
@@ -526,6 +697,12 @@ with col2:
     st.write("")
     clear_chat = st.button("🗑️ クリア", help="チャット履歴をクリア")
 
+refresh_analysis = st.checkbox(
+    "🔄 キャッシュを使わずにSQLを生成し直す",
+    value=False,
+    help=f"オフの場合、同じ質問・モデルで生成されたSQLと説明文を{ANALYST_RESPONSE_CACHE_TTL // 60}分間再利用します（SQLは毎回実行するため、データは常に最新です）"
+)
+
 # 分析実行処理
 if st.button("🚀 Cortex Analyst分析", type="primary", use_container_width=True):
     if user_question:
@@ -533,32 +710,24 @@ if st.button("🚀 Cortex Analyst分析", type="primary", use_container_width=Tr
         st.session_state.analyst_chat_history.append({"role": "user", "content": user_question})
         
         with st.spinner("🧠 Cortex Analystが分析中..."):
-            # Cortex Analyst分析を実行
-            current_model_info = get_model_info_from_display_name(selected_semantic_model, all_semantic_models)
-            result = execute_cortex_analyst_query(user_question, current_model_info)
+            # Cortex Analyst分析を実行（モデル情報はサイドバーで解決済みのものを使用）
+            result = run_cortex_analyst_query(user_question, model_info, refresh=refresh_analysis, approximate=fast_preview)
             
             if result["success"]:
                 response_text = result.get("response_text", "分析が完了しました。")
                 
                 # アシスタントの応答を履歴に追加
-                st.session_state.analyst_chat_history.append({
-                    "role": "analyst", 
-                    "content": response_text,
-                    "result": result
-                })
+                append_analyst_message(response_text, result)
             else:
                 error_message = f"申し訳ありません。分析中にエラーが発生しました。\n\n**エラー内容**: {result['message']}"
-                st.session_state.analyst_chat_history.append({
-                    "role": "analyst", 
-                    "content": error_message,
-                    "result": result
-                })
+                append_analyst_message(error_message, result)
         
         st.rerun()
 
 # チャットクリア処理
 if clear_chat:
     st.session_state.analyst_chat_history = []
+    st.session_state.analyst_result_cache = {}
     st.rerun()
 
 # =========================================================
@@ -583,23 +752,14 @@ for i, question in enumerate(analysis_templates):
             st.session_state.analyst_chat_history.append({"role": "user", "content": question})
             
             with st.spinner("🧠 Cortex Analystが分析中..."):
-                template_model_info = get_model_info_from_display_name(selected_semantic_model, all_semantic_models)
-                result = execute_cortex_analyst_query(question, template_model_info)
+                result = run_cortex_analyst_query(question, model_info, refresh=refresh_analysis, approximate=fast_preview)
                 
                 if result["success"]:
                     response_text = result.get("response_text", "分析が完了しました。")
-                    st.session_state.analyst_chat_history.append({
-                        "role": "analyst", 
-                        "content": response_text,
-                        "result": result
-                    })
+                    append_analyst_message(response_text, result)
                 else:
                     error_message = f"分析中にエラーが発生しました: {result['message']}"
-                    st.session_state.analyst_chat_history.append({
-                        "role": "analyst", 
-                        "content": error_message,
-                        "result": result
-                    })
+                    append_analyst_message(error_message, result)
             
             st.rerun()
 
@@ -14,8 +14,11 @@ import streamlit as st
 import pandas as pd
 import json
 from snowflake.snowpark.context import get_active_session
+from snowflake.snowpark.exceptions import SnowparkSQLException
 from datetime import datetime
 from snowflake.core import Root
+from snowflake.cortex import complete
+from typing import Iterator
 
 # ページ設定
 st.set_page_config(layout="wide")
@@ -23,7 +26,7 @@ st.set_page_config(layout="wide")
 # =========================================================
 # Snowflakeセッション接続
 # =========================================================
-@st.cache_resource
+@st.cache_resource(show_spinner=False)
 def get_snowflake_session():
     """Snowflakeセッションを取得（キャッシュ付き）"""
     return get_active_session()
@@ -33,6 +36,12 @@ session = get_snowflake_session()
 # Snowflake Root オブジェクトの初期化（Cortex Search Python API用）
 root = Root(session)
 
+@st.cache_resource
+def get_current_db_schema() -> tuple:
+    """現在のデータベースとスキーマを取得（セッション中は不変のためキャッシュ）"""
+    current_db_schema = session.sql("SELECT CURRENT_DATABASE(), CURRENT_SCHEMA()").collect()[0]
+    return current_db_schema['CURRENT_DATABASE()'], current_db_schema['CURRENT_SCHEMA()']
+
 # =========================================================
 # 設定値（定数）
 # =========================================================
@@ -46,31 +55,116 @@ LLM_MODELS = [
 # Cortex Searchサービス名
 SEARCH_SERVICE_NAME = "SNOW_RETAIL_SEARCH_SERVICE"
 
+# 質問カテゴリ（社内ドキュメントに基づく回答可能な質問）
+QUESTION_CATEGORIES = {
+    "商品・サービス": [
+        "プライベートブランド商品の特徴について教えてください",
+        "スノーフレッシュ オーガニック野菜シリーズについて詳しく教えてください",
+        "商品の返品・交換の条件を教えてください",
+        "PB商品の品質保証について教えてください"
+    ],
+    "店舗・サービス": [
+        "ポイントカードの有効期限について教えてください",
+        "ネットスーパーの配送料金と時間帯について教えてください",
+        "店舗での商品取り置きサービスについて教えてください",
+        "店舗の接客方針について教えてください"
+    ],
+    "企業・戦略": [
+        "スノーリテールの基本理念について教えてください",
+        "顧客満足度向上のための取り組みについて教えてください",
+        "物流・在庫管理の改善について教えてください",
+        "オムニチャネル戦略について教えてください"
+    ]
+}
+
+# RAGコンテキストに含める1ドキュメントあたりの最大文字数
+# （関連ドキュメント数は最大5件のため、コンテキスト全体も約7,500文字以内に収まる）
+MAX_CONTEXT_CHARS_PER_DOC = 1500
+
+# RAG応答生成用のシステムプロンプト（企業ドメインに特化）
+RAG_SYSTEM_PROMPT = """あなたは企業のカスタマーサポート担当者です。
+ユーザーメッセージで与えられる企業の公式ドキュメントの情報を基に、お客様の質問に正確にお答えください。
+
+回答の際は以下を心がけてください：
+- 企業ドキュメントの情報を最優先に使用
+- 情報が不足している場合は、「詳細については○○部門にお問い合わせください」などの案内を含める
+- 親切で分かりやすい言葉で回答
+- 必要に応じて手順を番号付きで説明"""
+
 # セッション状態の初期化
 if 'selected_llm_model' not in st.session_state:
     st.session_state.selected_llm_model = LLM_MODELS[0]
 
+# チャット履歴と統計の初期化（統計は履歴追加時に更新し、表示のたびに再集計しない）
+if "rag_chat_history" not in st.session_state:
+    st.session_state.rag_chat_history = []
+if "rag_chat_stats" not in st.session_state:
+    st.session_state.rag_chat_stats = {"user": 0, "assistant": 0, "with_sources": 0}
+# 回答待ちの質問（回答が完了した時点で履歴に追加し、クリアする）
+if "rag_pending_question" not in st.session_state:
+    st.session_state.rag_pending_question = None
+
 # =========================================================
 # データ・サービス確認関数
 # =========================================================
+@st.cache_data(ttl=60, show_spinner=False)
+def load_existing_tables() -> dict:
+    """
+    現在のスキーマに存在するテーブル名とレコード数（メタデータ）を取得（60秒キャッシュ）
+    取得に失敗した場合は例外を送出するため、失敗結果はキャッシュされない
+    
+    Returns:
+        dict: テーブル名（大文字）をキー、ROW_COUNTを値とする辞書
+    """
+    rows = session.sql("""
+        SELECT TABLE_NAME, ROW_COUNT FROM INFORMATION_SCHEMA.TABLES
+        WHERE TABLE_SCHEMA = CURRENT_SCHEMA()
+    """).collect()
+    return {row['TABLE_NAME']: row['ROW_COUNT'] or 0 for row in rows}
+
+def get_existing_tables() -> dict:
+    """
+    テーブル名とレコード数の一覧を取得（取得に失敗した場合は空の辞書を返し、次回の呼び出しで再取得）
+    
+    Returns:
+        dict: テーブル名（大文字）をキー、ROW_COUNTを値とする辞書
+    """
+    try:
+        return load_existing_tables()
+    except SnowparkSQLException:
+        return {}
+
 def check_table_exists(table_name: str) -> bool:
     """
-    指定されたテーブルが存在するかを確認
+    指定されたテーブルが存在するかを確認（メタデータのみ参照し、テーブルはスキャンしない）
     
     Args:
         table_name: 確認するテーブル名
     Returns:
         bool: テーブルが存在すればTrue
     """
-    try:
-        session.sql(f"SELECT 1 FROM {table_name} LIMIT 1").collect()
-        return True
-    except:
-        return False
+    return table_name.upper() in get_existing_tables()
+
+@st.cache_data(ttl=60, show_spinner=False)
+def load_cortex_search_service(service_name: str) -> bool:
+    """
+    Cortex Searchサービスが存在するかを確認（60秒キャッシュ）
+    取得に失敗した場合は例外を送出するため、失敗結果はキャッシュされない
+    
+    Args:
+        service_name: 確認するサービス名
+    Returns:
+        bool: サービスが存在すればTrue
+    """
+    # SHOWコマンドはバインド変数を使えないため、名前は引用符をエスケープして埋め込み、結果は名前の完全一致で判定
+    # （LIKEの「_」は任意の1文字に一致するため）
+    escaped_name = service_name.replace("'", "''")
+    result = session.sql(f"SHOW CORTEX SEARCH SERVICES LIKE '{escaped_name}'").collect()
+    return any(row['name'].upper() == service_name.upper() for row in result)
 
 def check_cortex_search_service(service_name: str) -> bool:
     """
-    Cortex Searchサービスが利用可能かを確認
+    Cortex Searchサービスが利用可能かを確認（取得に失敗した場合はFalseを返し、次回の呼び出しで再確認）
     
     Args:
         service_name: 確認するサービス名
@@ -78,29 +172,97 @@ def check_cortex_search_service(service_name: str) -> bool:
         bool: サービスが利用可能ならTrue
     """
     try:
-        result = session.sql(f"SHOW CORTEX SEARCH SERVICES LIKE '{service_name}'").collect()
-        return len(result) > 0
-    except:
+        return load_cortex_search_service(service_name)
+    except SnowparkSQLException:
         return False
 
 def get_table_count(table_name: str) -> int:
     """
-    テーブルのレコード数を取得
+    テーブルのレコード数を取得（メタデータのROW_COUNTを参照し、テーブルはスキャンしない）
     
     Args:
         table_name: カウントするテーブル名
     Returns:
         int: レコード数
     """
-    try:
-        result = session.sql(f"SELECT COUNT(*) as count FROM {table_name}").collect()
-        return result[0]['COUNT']
-    except:
-        return 0
+    return get_existing_tables().get(table_name.upper(), 0)
+
+def truncate_text(text: str, max_chars: int) -> str:
+    """
+    指定文字数を超えるテキストを切り詰める
+    
+    Args:
+        text: 対象のテキスト
+        max_chars: 最大文字数
+    Returns:
+        str: 切り詰めたテキスト（超過時は末尾に「...」を付与）
+    """
+    return text if len(text) <= max_chars else text[:max_chars] + "..."
 
 # =========================================================
 # Cortex Search関数（Python API使用）
 # =========================================================
+@st.cache_data(ttl=600, show_spinner=False)
+def fetch_cortex_search_results(query: str, service_name: str, limit: int,
+                                department_filter: str, doc_type_filter: str) -> list:
+    """
+    Cortex SearchのPython APIで検索を実行（同じ条件の検索結果は10分キャッシュ）
+    
+    Args:
+        query: 検索クエリ
+        service_name: Cortex Searchサービス名
+        limit: 検索結果の上限数
+        department_filter: 部署フィルタ
+        doc_type_filter: ドキュメントタイプフィルタ
+    Returns:
+        list: 検索結果のリスト
+    """
+    # 現在のデータベースとスキーマを取得
+    current_database, current_schema = get_current_db_schema()
+    
+    # Cortex Search Serviceの取得
+    search_service = (
+        root.databases[current_database]
+        .schemas[current_schema]
+        .cortex_search_services[service_name.lower()]
+    )
+    
+    # 検索の実行
+    search_args = {
+        "query": query,
+        "columns": ["title", "content", "document_type", "department"],
+        "limit": limit
+    }
+    
+    # フィルタ条件の構築（Cortex Search APIの正しい辞書形式）
+    filter_conditions = []
+    if department_filter != "すべて":
+        filter_conditions.append({"@eq": {"department": department_filter}})
+    if doc_type_filter != "すべて":
+        filter_conditions.append({"@eq": {"document_type": doc_type_filter}})
+    
+    # フィルタが指定されている場合は追加
+    if filter_conditions:
+        if len(filter_conditions) == 1:
+            search_args["filter"] = filter_conditions[0]
+        else:
+            # 複数の条件がある場合は@andで結合
+            search_args["filter"] = {"@and": filter_conditions}
+    
+    search_results = search_service.search(**search_args)
+    
+    # 検索結果を辞書のリストに変換（キャッシュ可能な形式）
+    results = []
+    for result in search_results.results:
+        results.append({
+            "title": result.get("title", "タイトルなし"),
+            "content": result.get("content", ""),
+            "document_type": result.get("document_type", "N/A"),
+            "department": result.get("department", "N/A")
+        })
+    
+    return results
+
 def search_documents_with_cortex(query: str, service_name: str = SEARCH_SERVICE_NAME, limit: int = 3, 
                                 department_filter: str = "すべて", doc_type_filter: str = "すべて") -> list:
     """
@@ -117,54 +279,8 @@ def search_documents_with_cortex(query: str, service_name: str = SEARCH_SERVICE_
         list: 検索結果のリスト
     """
     try:
-        # 現在のデータベースとスキーマを取得
-        current_db_schema = session.sql("SELECT CURRENT_DATABASE(), CURRENT_SCHEMA()").collect()[0]
-        current_database = current_db_schema['CURRENT_DATABASE()']
-        current_schema = current_db_schema['CURRENT_SCHEMA()']
-        
-        # Cortex Search Serviceの取得
-        search_service = (
-            root.databases[current_database]
-            .schemas[current_schema]
-            .cortex_search_services[service_name.lower()]
-        )
-        
-        # 検索の実行
-        search_args = {
-            "query": query,
-            "columns": ["title", "content", "document_type", "department"],
-            "limit": limit
-        }
-        
-        # フィルタ条件の構築（Cortex Search APIの正しい辞書形式）
-        filter_conditions = []
-        if department_filter != "すべて":
-            filter_conditions.append({"@eq": {"department": department_filter}})
-        if doc_type_filter != "すべて":
-            filter_conditions.append({"@eq": {"document_type": doc_type_filter}})
-        
-        # フィルタが指定されている場合は追加
-        if filter_conditions:
-            if len(filter_conditions) == 1:
-                search_args["filter"] = filter_conditions[0]
-            else:
-                # 複数の条件がある場合は@andで結合
-                search_args["filter"] = {"@and": filter_conditions}
-        
-        search_results = search_service.search(**search_args)
-        
-        # 検索結果を辞書のリストに変換
-        results = []
-        for result in search_results.results:
-            results.append({
-                "title": result.get("title", "タイトルなし"),
-                "content": result.get("content", ""),
-                "document_type": result.get("document_type", "N/A"),
-                "department": result.get("department", "N/A")
-            })
-        
-        return results
-        
+        # エラー時の空結果はキャッシュしないよう、例外はここで処理する
+        return fetch_cortex_search_results(query, service_name, limit, department_filter, doc_type_filter)
     except Exception as e:
         st.error(f"検索エラー: {str(e)}")
         return []
@@ -172,46 +288,122 @@ def search_documents_with_cortex(query: str, service_name: str = SEARCH_SERVICE_
 # =========================================================
 # RAG応答生成関数
 # =========================================================
-def generate_rag_response(question: str, context: str, model: str) -> str:
+def generate_rag_response(question: str, context: str, model: str) -> Iterator[str]:
     """
-    検索結果を基にRAG応答を生成
-    企業ドメインの知識を活用した正確な回答を生成
+    検索結果を基にRAG応答をストリーミング生成
+    企業ドメインの知識を活用した正確な回答を、生成された部分から順に返す
     
     Args:
         question: ユーザーの質問
         context: 検索で取得したコンテキスト情報
         model: 使用するLLMモデル
     Returns:
-        str: 生成された回答
+        Iterator[str]: 生成された回答の断片（生成エラーは呼び出し元へ送出）
     """
-    try:
-        # 企業ドメインに特化したプロンプト
-        prompt = f"""あなたは企業のカスタマーサポート担当者です。
-以下の企業の公式ドキュメントから得られた情報を基に、お客様の質問に正確にお答えください。
-
-企業ドキュメントの情報:
-{context}
+    # 固定の指示はsystem、ドキュメントと質問はuserメッセージとして渡す
+    messages = [
+        {"role": "system", "content": RAG_SYSTEM_PROMPT},
+        {"role": "user", "content": f"企業ドキュメントの情報:\n{context}\n\nお客様の質問: {question}"}
+    ]
+    # Cortex COMPLETEで回答をストリーミング生成
+    yield from complete(model, messages, session=session, stream=True)
 
-お客様の質問: {question}
+def ask_rag(question: str) -> None:
+    """
+    質問を回答待ちとして登録（回答は履歴表示時にストリーミング生成）
+    ボタンのコールバックとして実行するため、追加の再実行（st.rerun）は不要
+    回答が完了するまで履歴には追加しないため、生成中に別の操作で再実行されても次の実行で回答を再開できる
+    
+    Args:
+        question: ユーザーの質問
+    """
+    st.session_state.rag_pending_question = question
 
-回答の際は以下を心がけてください：
-- 企業ドキュメントの情報を最優先に使用
-- 情報が不足している場合は、「詳細については○○部門にお問い合わせください」などの案内を含める
-- 親切で分かりやすい言葉で回答
-- 必要に応じて手順を番号付きで説明"""
-        
-        # Cortex COMPLETEで回答生成
-        complete_query = f"""
-        SELECT SNOWFLAKE.CORTEX.COMPLETE(
-            '{model}',
-            '{prompt}'
-        ) as response
-        """
+def stream_rag_answer(question: str) -> None:
+    """
+    回答待ちの質問に対して検索→コンテキスト構築→RAG応答生成を行い、回答の完了後に質問と回答を履歴に追加
+    検索件数・フィルタはサイドバーの設定値を使用
+    生成エラー時はエラーを表示して回答待ちを解除し、履歴・統計には追加しない
+    
+    Args:
+        question: ユーザーの質問
+    """
+    with st.chat_message("user", avatar="👤"):
+        st.write(question)
+    
+    with st.spinner("🔍 企業ドキュメントを検索中..."):
+        # 企業ドキュメントから関連情報を検索（フィルタ適用）
+        search_results = search_documents_with_cortex(
+            question, SEARCH_SERVICE_NAME, search_limit,
+            filter_department, filter_doc_type
+        )
         
-        result = session.sql(complete_query).collect()
-        return result[0]['RESPONSE'] if result else "申し訳ございませんが、回答を生成できませんでした。"
-    except Exception as e:
-        return f"エラーが発生しました: {str(e)}"
+        # 検索結果をコンテキストに変換（中間リストを作らず直接結合、本文は文字数上限で切り詰め）
+        source_titles = [result.get('title', 'タイトルなし') for result in search_results]
+        context = "\n\n".join(
+            f"ドキュメント: {result.get('title', 'タイトルなし')}\n"
+            f"内容: {truncate_text(result.get('content', ''), MAX_CONTEXT_CHARS_PER_DOC)}"
+            for result in search_results
+        ) or "関連する企業ドキュメントが見つかりませんでした。"
+    
+    with st.chat_message("assistant", avatar="📖"):
+        # RAG応答を生成しながら表示
+        try:
+            rag_response = st.write_stream(
+                generate_rag_response(question, context, st.session_state.selected_llm_model)
+            )
+        except Exception as e:
+            st.error(f"❌ 回答生成エラー: {str(e)}")
+            st.session_state.rag_pending_question = None
+            return
+        if source_titles:
+            with st.expander("📚 参考にした企業ドキュメント"):
+                for i, source in enumerate(source_titles, 1):
+                    st.markdown(f"**{i}.** {source}")
+    
+    # 回答が完了した時点で質問とAI応答を履歴に追加し、回答待ちを解除
+    st.session_state.rag_chat_history.append({"role": "user", "content": question})
+    st.session_state.rag_chat_history.append({
+        "role": "assistant", 
+        "content": rag_response,
+        "sources": source_titles
+    })
+    st.session_state.rag_pending_question = None
+    st.session_state.rag_chat_stats["user"] += 1
+    st.session_state.rag_chat_stats["assistant"] += 1
+    if source_titles:
+        st.session_state.rag_chat_stats["with_sources"] += 1
+
+def format_history_markdown(messages: list) -> str:
+    """
+    過去の対話履歴を1つのMarkdown文字列にまとめる
+    
+    Args:
+        messages: 対話履歴のリスト
+    Returns:
+        str: 描画用のMarkdown文字列
+    """
+    parts = []
+    for message in messages:
+        if message["role"] == "user":
+            parts.append(f"**👤 ユーザー:** {message['content']}")
+        else:
+            part = f"**📖 アシスタント:**\n\n{message['content']}"
+            if message.get("sources"):
+                part += "\n\n📚 参考: " + " / ".join(message["sources"])
+            parts.append(part)
+    return "\n\n---\n\n".join(parts)
+
+def submit_rag_question():
+    """RAG回答生成ボタンのコールバック（入力欄の質問で回答を生成）"""
+    if st.session_state.rag_input:
+        ask_rag(st.session_state.rag_input)
+
+def clear_rag_chat():
+    """クリアボタンのコールバック（チャット履歴と統計をリセット）"""
+    st.session_state.rag_chat_history = []
+    st.session_state.rag_chat_stats = {"user": 0, "assistant": 0, "with_sources": 0}
+    st.session_state.rag_pending_question = None
 
 # =========================================================
 # メインページ
@@ -377,7 +569,7 @@ if st.button("🔎 検索実行", type="primary"):
                         col1, col2 = st.columns([3, 1])
                         
                         with col1:
-                            st.markdown(f"**内容:** {content[:300]}...")
+                            st.markdown(f"**内容:** {truncate_text(content, 300)}")
                         
                         with col2:
                             st.markdown(f"**種類:** {doc_type}")
@@ -393,14 +585,15 @@ st.markdown("---")
 st.subheader("🤖 Step2: RAGチャットボット")
 st.markdown("企業ドメインを理解したAIアシスタントとの対話")
 
-# チャット履歴の初期化
-if "rag_chat_history" not in st.session_state:
-    st.session_state.rag_chat_history = []
-
 # チャット履歴の表示
-if st.session_state.rag_chat_history:
+if st.session_state.rag_chat_history or st.session_state.rag_pending_question:
     st.markdown("#### 💭 対話履歴")
-    for message in st.session_state.rag_chat_history:
+    # 過去のやり取りは1つのMarkdownにまとめて描画し、最新のやり取りのみチャット形式で表示
+    past_messages = st.session_state.rag_chat_history[:-2]
+    if past_messages:
+        with st.container(border=True):
+            st.markdown(format_history_markdown(past_messages))
+    for message in st.session_state.rag_chat_history[-2:]:
         if message["role"] == "user":
             with st.chat_message("user", avatar="👤"):
                 st.write(message["content"])
@@ -412,12 +605,16 @@ if st.session_state.rag_chat_history:
                     with st.expander("📚 参考にした企業ドキュメント"):
                         for i, source in enumerate(message["sources"], 1):
                             st.markdown(f"**{i}.** {source}")
+    
+    # 回答待ちの質問があれば、回答をストリーミング表示（前回の生成が中断された場合もここで再開）
+    if st.session_state.rag_pending_question:
+        stream_rag_answer(st.session_state.rag_pending_question)
 
 # 質問入力エリア
 col1, col2 = st.columns([4, 1])
 
 with col1:
-    user_question = st.text_input(
+    st.text_input(
         "💬 企業について質問してください:",
         key="rag_input",
         placeholder="例: 商品が破損していた場合の対応について教えて"
@@ -425,50 +622,10 @@ with col1:
 
 with col2:
     st.write("")  # 高さ調整用
-    clear_chat = st.button("🗑️ クリア", help="チャット履歴をクリア")
+    st.button("🗑️ クリア", help="チャット履歴をクリア", on_click=clear_rag_chat)
 
-# 回答生成処理
-if st.button("🚀 RAG回答生成", type="primary", use_container_width=True):
-    if user_question:
-        # ユーザー質問を履歴に追加
-        st.session_state.rag_chat_history.append({"role": "user", "content": user_question})
-        
-        with st.spinner("🔍 関連情報を検索中..."):
-            # 企業ドキュメントから関連情報を検索（フィルタ適用）
-            search_results = search_documents_with_cortex(
-                user_question, SEARCH_SERVICE_NAME, search_limit,
-                filter_department, filter_doc_type
-            )
-            
-            # 検索結果をコンテキストに変換
-            context_documents = []
-            source_titles = []
-            
-            for result in search_results:
-                title = result.get('title', 'タイトルなし')
-                content = result.get('content', '')
-                context_documents.append(f"ドキュメント: {title}\n内容: {content}")
-                source_titles.append(title)
-            
-            context = "\n\n".join(context_documents) if context_documents else "関連する企業ドキュメントが見つかりませんでした。"
-        
-        with st.spinner("🤖 回答を生成中..."):
-            # RAG応答の生成
-            rag_response = generate_rag_response(user_question, context, st.session_state.selected_llm_model)
-            
-            # AI応答を履歴に追加
-            st.session_state.rag_chat_history.append({
-                "role": "assistant", 
-                "content": rag_response,
-                "sources": source_titles
-            })
-        
-        st.rerun()
-
-# チャットクリア処理
-if clear_chat:
-    st.session_state.rag_chat_history = []
-    st.rerun()
+# 回答生成処理（コールバックで処理するため、ボタン押下時の再実行1回で結果が表示される）
+st.button("🚀 RAG回答生成", type="primary", use_container_width=True, on_click=submit_rag_question)
 
 # =========================================================
 # よくある質問テンプレート
@@ -477,32 +634,10 @@ st.markdown("---")
 st.subheader("💡 よくある質問テンプレート")
 st.markdown("ワンクリックで企業に関する質問ができます")
 
-# 質問カテゴリ（社内ドキュメントに基づく回答可能な質問）
-question_categories = {
-    "商品・サービス": [
-        "プライベートブランド商品の特徴について教えてください",
-        "スノーフレッシュ オーガニック野菜シリーズについて詳しく教えてください",
-        "商品の返品・交換の条件を教えてください",
-        "PB商品の品質保証について教えてください"
-    ],
-    "店舗・サービス": [
-        "ポイントカードの有効期限について教えてください",
-        "ネットスーパーの配送料金と時間帯について教えてください",
-        "店舗での商品取り置きサービスについて教えてください",
-        "店舗の接客方針について教えてください"
-    ],
-    "企業・戦略": [
-        "スノーリテールの基本理念について教えてください",
-        "顧客満足度向上のための取り組みについて教えてください",
-        "物流・在庫管理の改善について教えてください",
-        "オムニチャネル戦略について教えてください"
-    ]
-}
-
 # タブで質問カテゴリを表示
-tab1, tab2, tab3 = st.tabs(list(question_categories.keys()))
+tab1, tab2, tab3 = st.tabs(list(QUESTION_CATEGORIES))
 
-for tab, (category, questions) in zip([tab1, tab2, tab3], question_categories.items()):
+for tab, (category, questions) in zip([tab1, tab2, tab3], QUESTION_CATEGORIES.items()):
     with tab:
         st.markdown(f"#### {category}に関する質問")
         
@@ -511,37 +646,9 @@ for tab, (category, questions) in zip([tab1, tab2, tab3], question_categories.it
         
         for i, question in enumerate(questions):
             with cols[i % 2]:
-                if st.button(question, key=f"template_{category}_{i}", use_container_width=True):
-                    # テンプレート質問を実行
-                    st.session_state.rag_chat_history.append({"role": "user", "content": question})
-                    
-                    with st.spinner("🔍 企業ドキュメントを検索中..."):
-                        search_results = search_documents_with_cortex(
-                            question, SEARCH_SERVICE_NAME, search_limit,
-                            filter_department, filter_doc_type
-                        )
-                        
-                        context_documents = []
-                        source_titles = []
-                        
-                        for result in search_results:
-                            title = result.get('title', 'タイトルなし')
-                            content = result.get('content', '')
-                            context_documents.append(f"ドキュメント: {title}\n内容: {content}")
-                            source_titles.append(title)
-                        
-                        context = "\n\n".join(context_documents) if context_documents else "関連する企業ドキュメントが見つかりませんでした。"
-                    
-                    with st.spinner("🤖 回答を生成中..."):
-                        rag_response = generate_rag_response(question, context, st.session_state.selected_llm_model)
-                        
-                        st.session_state.rag_chat_history.append({
-                            "role": "assistant", 
-                            "content": rag_response,
-                            "sources": source_titles
-                        })
-                    
-                    st.rerun()
+                # テンプレート質問をコールバックで実行
+                st.button(question, key=f"template_{category}_{i}", use_container_width=True,
+                          on_click=ask_rag, args=(question,))
 
 # =========================================================
 # RAG統計情報
@@ -551,12 +658,12 @@ st.subheader("📊 RAGチャットボット統計")
 
 col1, col2, col3, col4 = st.columns(4)
 
-# 統計計算
-total_messages = len(st.session_state.rag_chat_history)
-user_questions = len([msg for msg in st.session_state.rag_chat_history if msg["role"] == "user"])
-ai_responses = len([msg for msg in st.session_state.rag_chat_history if msg["role"] == "assistant"])
-responses_with_sources = len([msg for msg in st.session_state.rag_chat_history 
-                             if msg["role"] == "assistant" and msg.get("sources")])
+# 統計計算（履歴追加時に集計済みの値を使用）
+rag_chat_stats = st.session_state.rag_chat_stats
+user_questions = rag_chat_stats["user"]
+ai_responses = rag_chat_stats["assistant"]
+responses_with_sources = rag_chat_stats["with_sources"]
+total_messages = user_questions + ai_responses
 
 with col1:
     st.metric("💬 総メッセージ", f"{total_messages}件")
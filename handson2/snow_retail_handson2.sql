@@ -20,13 +20,13 @@ USE warehouse compute_wh;
 SELECT SNOWFLAKE.CORTEX.TRANSLATE('こんにちは！あなたは誰ですか？', '', 'en') as translated;
 
 -- ※ハンズオン※
--- Streamlitの112行目付近の『★★★修正対象★★★』を書き換えてみましょう
+-- Streamlitの66行目付近の『★★★修正対象★★★』を書き換えてみましょう
 
 -- 感情分析機能（基本版）
 SELECT SNOWFLAKE.CORTEX.SENTIMENT('This is really the best!') as basic_sentiment;
 
 -- ※ハンズオン※
--- Streamlitの116行目付近の『★★★修正対象★★★』を書き換えてみましょう
+-- Streamlitの65行目付近の『★★★修正対象★★★』を書き換えてみましょう
 
 -- 感情分析機能（エンティティ対応高精度版）- 特定の観点での感情分析が可能
 SELECT SNOWFLAKE.CORTEX.ENTITY_SENTIMENT(
@@ -43,13 +43,13 @@ SELECT SNOWFLAKE.CORTEX.SPLIT_TEXT_RECURSIVE_CHARACTER(
 ) as split_result;
 
 -- ※ハンズオン※
--- Streamlitの123行目付近の『★★★修正対象★★★』を書き換えてみましょう
+-- Streamlitの79行目付近の『★★★修正対象★★★』を書き換えてみましょう
 
 -- 埋め込み機能（ベクトル検索用）
 SELECT SNOWFLAKE.CORTEX.EMBED_TEXT_1024('multilingual-e5-large', '今日は仕事が忙しいですね。');
 
 -- ※ハンズオン※
--- Streamlitの140行目付近の『★★★修正対象★★★』を書き換えてみましょう
+-- Streamlitの74行目付近の『★★★修正対象★★★』を書き換えてみましょう
 
 -- =========================================================
 -- Step2: 顧客の声分析
@@ -63,7 +63,7 @@ SELECT
     ) as classification;
 
 -- ※ハンズオン※
--- Streamlitの173行目付近の『★★★修正対象★★★』を書き換えてみましょう
+-- Streamlitの294行目付近の『★★★修正対象★★★』を書き換えてみましょう
 
 -- AI_FILTER関数による条件フィルタリング
 SELECT 
@@ -75,7 +75,7 @@ WHERE AI_FILTER(CONCAT('商品の品質について言及されているか？:
 LIMIT 10;
 
 -- ※ハンズオン※
--- Streamlitの314行目付近の『★★★修正対象★★★』を書き換えてみましょう
+-- Streamlitの499行目付近の『★★★修正対象★★★』を書き換えてみましょう
 
 -- AI_AGG関数による集約分析 (購入チャネル別)
 SELECT 
@@ -88,7 +88,7 @@ FROM CUSTOMER_REVIEWS
 GROUP BY purchase_channel;
 
 -- ※ハンズオン※
--- Streamlitの415行目付近の『★★★修正対象★★★』を書き換えてみましょう
+-- Streamlitの597行目付近の『★★★修正対象★★★』を書き換えてみましょう
 
 -- AI_SUMMARIZE_AGG関数による要約 (購入チャネル別)
 SELECT 
@@ -104,7 +104,7 @@ SELECT
     AI_SIMILARITY('今日は良い天気です', '天候が素晴らしいですね') as similarity_score;
 
 -- ※ハンズオン※
--- Streamlitの479行目付近の『★★★修正対象★★★』を書き換えてみましょう
+-- Streamlitの661行目付近の『★★★修正対象★★★』を書き換えてみましょう
 
 -- =========================================================
 -- (Option) Step2': 高度なレビュー分析とフィルタリング
@@ -156,10 +156,10 @@ GROUP BY purchase_channel;
 SELECT AI_COMPLETE('llama4-maverick', 'Snowflakeの特徴を端的に教えてください。');
 
 -- ※ハンズオン※
--- Streamlitの50行目付近の『★★★修正対象★★★』を書き換えてみましょう
+-- Streamlitの92行目付近の『★★★修正対象★★★』を書き換えてみましょう
 
 -- ※(Option) ハンズオン※
--- Streamlitの29行目付近を書き換えて他のLLMモデルを追加してみましょう
+-- Streamlitの30行目付近を書き換えて他のLLMモデルを追加してみましょう
 -- <https://docs.snowflake.com/en/sql-reference/functions/ai_complete-single-string#arguments>
 
 -- =========================================================